@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# filename: aio.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Asyncio interface to calibration and plotting.
+
+Calibration and plotting are CPU bound and would block the event loop,
+so they run in an executor: the default thread pool of the loop, or any
+``concurrent.futures`` executor, including a process pool. Calibrated
+ages pickle their curve by reference, so they travel cheaply between
+processes.
+
+Single calibrations requested at the same time are gathered in micro
+batches and calibrated in one vectorized call. Pending requests wait in
+a bounded queue: when it is full, callers wait too, instead of piling up
+work in memory.
+
+::
+
+    calibrator = aio.Calibrator()
+    calibrated_age = await calibrator.calibrate(3000, 30, 'P-1')
+    png = await calibrator.render(calibrated_age)
+
+'''
+
+import asyncio
+
+from collections import defaultdict
+from io import BytesIO
+
+from iosacal import core, plot
+from iosacal.worker import DEFAULT_CURVE
+
+
+def _calibrate_batch(determinations, curve, mass):
+    return core.calibrate_batch(determinations, curve, mass)
+
+
+def _render(calibrated_age, format, kwargs):
+    output = BytesIO()
+    plot.single_plot(calibrated_age, output=output, format=format, **kwargs)
+    return output.getvalue()
+
+
+class Calibrator(object):
+    '''Awaitable calibration, batched and offloaded to an executor.
+
+    ``executor`` is a ``concurrent.futures`` executor, or ``None`` for the
+    default one of the event loop. Up to ``max_batch`` single requests
+    are calibrated together, waiting at most ``max_delay`` seconds for a
+    batch to fill. At most ``max_pending`` requests wait in the queue and
+    ``max_running`` jobs run in the executor at the same time.
+
+    '''
+
+    def __init__(self, executor=None, curve=DEFAULT_CURVE, mass=1 - 1e-6,
+                 max_batch=256, max_delay=0.002, max_pending=1024,
+                 max_running=4):
+        self.executor = executor
+        self.curve = curve
+        self.mass = mass
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_running = max_running
+        self.batches = 0
+        self._loop = None
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue(self.max_pending)
+            self._running = asyncio.Semaphore(self.max_running)
+            self._batcher = loop.create_task(self._batch_requests())
+        return loop
+
+    async def _offload(self, function, *args):
+        async with self._running:
+            return await self._loop.run_in_executor(self.executor, function, *args)
+
+    async def _batch_requests(self):
+        while True:
+            requests = [await self._queue.get()]
+            deadline = self._loop.time() + self.max_delay
+            while len(requests) < self.max_batch:
+                timeout = deadline - self._loop.time()
+                try:
+                    requests.append(self._queue.get_nowait() if timeout <= 0 else
+                                    await asyncio.wait_for(self._queue.get(), timeout))
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+            by_curve = defaultdict(list)
+            for determination, curve, future in requests:
+                if not future.cancelled():
+                    by_curve[curve].append((determination, future))
+            for curve, group in by_curve.items():
+                # wait for a free slot here, so that the queue fills up
+                # and callers wait when the executor is busy
+                await self._running.acquire()
+                self._loop.create_task(self._run_batch(curve, group))
+
+    async def _run_batch(self, curve, group):
+        try:
+            determinations = [d for d, future in group]
+            results = await self._loop.run_in_executor(
+                self.executor, _calibrate_batch, determinations, curve, self.mass)
+        except Exception as e:
+            for d, future in group:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (d, future), calibrated_age in zip(group, results):
+                if not future.done():
+                    future.set_result(calibrated_age)
+        finally:
+            self.batches += 1
+            self._running.release()
+
+    async def calibrate(self, date, sigma, id=None, curve=None):
+        '''Calibrate one determination, batched with concurrent requests.'''
+
+        loop = self._start()
+        future = loop.create_future()
+        await self._queue.put((core.R(date, sigma, id), curve or self.curve, future))
+        return await future
+
+    async def calibrate_batch(self, determinations, curve=None):
+        '''Calibrate a list of determinations in one executor job.'''
+
+        self._start()
+        return await self._offload(_calibrate_batch, list(determinations),
+                                   curve or self.curve, self.mass)
+
+    async def render(self, calibrated_age, format='png', **kwargs):
+        '''Return the bytes of the plot of a calibrated age.
+
+        Keyword arguments are passed to ``plot.single_plot``.
+
+        '''
+
+        self._start()
+        return await self._offload(_render, calibrated_age, format, kwargs)
+
+    async def close(self):
+        '''Stop batching; requests still queued are cancelled.'''
+
+        if self._loop is not None:
+            self._batcher.cancel()
+            while not self._queue.empty():
+                self._queue.get_nowait()[2].cancel()
+            self._loop = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+_default = None
+
+
+def get_calibrator():
+    '''Return the calibrator used by the module functions.'''
+
+    global _default
+    if _default is None:
+        _default = Calibrator()
+    return _default
+
+
+async def calibrate(date, sigma, id=None, curve=None):
+    return await get_calibrator().calibrate(date, sigma, id, curve)
+
+
+async def calibrate_batch(determinations, curve=None):
+    return await get_calibrator().calibrate_batch(determinations, curve)
+
+
+async def render(calibrated_age, format='png', **kwargs):
+    return await get_calibrator().render(calibrated_age, format, **kwargs)
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# filename: archive.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Columnar archive of calibrated ages.
+
+An archive is a directory holding the results of a batch calibration
+against one curve:
+
+``meta.json``
+    curve reference (name and checksum) and calendar grid;
+``grid.f8``
+    the years of the curve grid followed by one row of probabilities
+    per sample, as raw float64;
+``samples.rec``
+    a fixed-size record per sample: date, sigma, the window of the
+    grid row holding non-zero probabilities, discarded mass and the
+    position of its HPD intervals;
+``hpd.f8``
+    HPD interval bounds of all samples, as raw float64 pairs;
+``ids.jsonl``
+    sample identifiers, one JSON value per line.
+
+All files are only ever appended to, so an archive is written one sample
+at a time and can be extended later. The record of a sample is written
+last: a sample without its record, left by an interrupted write, is cut
+away when the archive is opened for writing again. Reading maps the
+files in memory, and each sample is returned as a ``CalAge`` view on the
+grid file, without copying.
+
+'''
+
+import json
+import os
+
+import numpy as np
+
+from numpy.lib.stride_tricks import as_strided
+
+from iosacal import core, curves
+
+VERSION = 1
+
+RECORD = np.dtype([
+    ('date', 'f8'),
+    ('sigma', 'f8'),
+    ('start', 'i8'),
+    ('stop', 'i8'),
+    ('discarded_mass', 'f8'),
+    ('hpd68', 'i8'),
+    ('n68', 'i8'),
+    ('hpd95', 'i8'),
+    ('n95', 'i8'),
+    ])
+
+_META = 'meta.json'
+_GRID = 'grid.f8'
+_RECORDS = 'samples.rec'
+_HPD = 'hpd.f8'
+_IDS = 'ids.jsonl'
+
+
+_FILES = (_META, _GRID, _RECORDS, _HPD, _IDS)
+
+
+def remove(path):
+    '''Delete the files of an archive, leaving its directory.'''
+
+    for name in _FILES:
+        if os.path.exists(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
+
+
+def _read_meta(path):
+    with open(os.path.join(path, _META)) as f:
+        return json.load(f)
+
+
+class ArchiveWriter(object):
+    '''Append calibrated ages to an archive.
+
+    ``curve`` is the calibration curve of all samples. If the archive
+    already exists, new samples are appended to it, as long as it was
+    made with the same curve.
+
+    '''
+
+    def __init__(self, path, curve):
+        self.path = path
+        self.years = np.asarray(curve[:,0])
+        name, checksum = curves.reference(curve)
+        meta = {
+            'version': VERSION,
+            'curve': name,
+            'checksum': checksum,
+            'title': curve.title,
+            'top': float(self.years[0]),
+            'length': len(self.years),
+            }
+        if os.path.exists(os.path.join(path, _META)):
+            existing = _read_meta(path)
+            for key in ('curve', 'checksum', 'top', 'length'):
+                if existing[key] != meta[key]:
+                    raise ValueError('Archive %s was made with a different '
+                                     'curve or grid (%s)' % (path, key))
+            self.rows, hpd_pairs = self._repair(path, len(self.years))
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(os.path.join(path, _META), 'w') as f:
+                json.dump(meta, f, indent=1)
+            with open(os.path.join(path, _GRID), 'wb') as f:
+                f.write(self.years.astype('f8').tobytes())
+            self.rows, hpd_pairs = 0, 0
+        self._hpd_pairs = hpd_pairs
+        self._grid = open(os.path.join(path, _GRID), 'ab')
+        self._records = open(os.path.join(path, _RECORDS), 'ab')
+        self._hpd = open(os.path.join(path, _HPD), 'ab')
+        self._ids = open(os.path.join(path, _IDS), 'a')
+
+    @staticmethod
+    def _repair(path, G):
+        '''Cut all files to the last complete sample.
+
+        Return the number of samples and of HPD pairs.
+
+        '''
+
+        join = lambda name: os.path.join(path, name)
+        n, _ = Archive._sizes(path, G)
+        offsets = [0]
+        if os.path.exists(join(_IDS)):
+            with open(join(_IDS), 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n') or len(offsets) > n:
+                        break
+                    offsets.append(offsets[-1] + len(line))
+        n = len(offsets) - 1
+        hpd_pairs = 0
+        if n:
+            with open(join(_RECORDS), 'rb') as f:
+                f.seek((n - 1) * RECORD.itemsize)
+                last = np.frombuffer(f.read(RECORD.itemsize), dtype=RECORD)[0]
+            hpd_pairs = int(last['hpd95'] + last['n95'])
+        for name, size in ((_GRID, (n + 1) * G * 8),
+                           (_RECORDS, n * RECORD.itemsize),
+                           (_HPD, hpd_pairs * 16),
+                           (_IDS, offsets[-1])):
+            if os.path.exists(join(name)) and os.path.getsize(join(name)) > size:
+                os.truncate(join(name), size)
+        return n, hpd_pairs
+
+    def append(self, calibrated_age):
+        '''Write one calibrated age at the end of the archive.'''
+
+        index = np.rint(self.years[0] - calibrated_age[:,0]).astype(int)
+        start, stop = index.min(), index.max() + 1
+        if start < 0 or stop > len(self.years):
+            raise ValueError('Calibrated age lies outside the archive grid')
+        row = np.zeros(len(self.years))
+        row[index] = calibrated_age[:,1]
+
+        rs = calibrated_age.radiocarbon_sample
+        intervals68 = np.asarray(calibrated_age.intervals68, dtype='f8').reshape(-1, 2)
+        intervals95 = np.asarray(calibrated_age.intervals95, dtype='f8').reshape(-1, 2)
+        record = np.zeros(1, dtype=RECORD)
+        record['date'] = rs.date
+        record['sigma'] = rs.sigma
+        record['start'] = start
+        record['stop'] = stop
+        record['discarded_mass'] = getattr(calibrated_age, 'discarded_mass', 0.0)
+        record['hpd68'] = self._hpd_pairs
+        record['n68'] = len(intervals68)
+        record['hpd95'] = self._hpd_pairs + len(intervals68)
+        record['n95'] = len(intervals95)
+
+        self._hpd.write(intervals68.tobytes())
+        self._hpd.write(intervals95.tobytes())
+        self._grid.write(row.tobytes())
+        self._ids.write(json.dumps(rs.id) + '\n')
+        # last, it marks the sample as complete
+        self._records.write(record.tobytes())
+        self._hpd_pairs += len(intervals68) + len(intervals95)
+        self.rows += 1
+
+    def extend(self, calibrated_ages):
+        for calibrated_age in calibrated_ages:
+            self.append(calibrated_age)
+
+    def flush(self):
+        for f in (self._hpd, self._grid, self._records, self._ids):
+            f.flush()
+
+    def close(self):
+        for f in (self._hpd, self._grid, self._records, self._ids):
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Archive(object):
+    '''A read-only, memory mapped archive of calibrated ages.
+
+    ``probabilities`` is the (samples, years) matrix on the curve grid
+    ``years``; ``ids``, ``dates``, ``sigmas`` and ``discarded_mass`` are
+    per-sample arrays. Indexing returns a ``CalAge`` that shares memory
+    with the archive.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        meta = _read_meta(path)
+        self.curve_name = meta['curve']
+        self.curve_checksum = meta['checksum']
+        self.curve_title = meta['title']
+        G = meta['length']
+        n, hpd_pairs = self._sizes(path, G)
+        with open(os.path.join(path, _IDS)) as f:
+            self.ids = [json.loads(line) for _, line in zip(range(n), f)]
+        n = len(self.ids)
+        self._grid = np.memmap(os.path.join(path, _GRID), dtype='f8',
+                               mode='r', shape=(n + 1, G))
+        self.years = self._grid[0]
+        self.probabilities = self._grid[1:]
+        self.records = (np.memmap(os.path.join(path, _RECORDS), dtype=RECORD,
+                                  mode='r', shape=(n,))
+                        if n else np.zeros(0, dtype=RECORD))
+        self.hpd = (np.memmap(os.path.join(path, _HPD), dtype='f8',
+                              mode='r', shape=(hpd_pairs, 2))
+                    if hpd_pairs else np.zeros((0, 2)))
+        self.dates = self.records['date']
+        self.sigmas = self.records['sigma']
+        self.discarded_mass = self.records['discarded_mass']
+        self._curve = None
+
+    @staticmethod
+    def _sizes(path, G):
+        '''Number of complete samples and of HPD pairs in an archive.'''
+
+        size = lambda name: (os.path.getsize(os.path.join(path, name))
+                             if os.path.exists(os.path.join(path, name)) else 0)
+        n = min(size(_GRID) // (8 * G) - 1, size(_RECORDS) // RECORD.itemsize)
+        return n, size(_HPD) // 16
+
+    @property
+    def curve(self):
+        '''The calibration curve, resolved from the registry on first use.'''
+
+        if self._curve is None and self.curve_name is not None:
+            self._curve = curves.resolve(self.curve_name, self.curve_checksum)
+        return self._curve
+
+    def intervals(self, i):
+        '''Return the 68.2% and 95.4% HPD intervals of sample ``i``.'''
+
+        r = self.records[i]
+        return (self.hpd[r['hpd68']:r['hpd68'] + r['n68']],
+                self.hpd[r['hpd95']:r['hpd95'] + r['n95']])
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('archive index out of range')
+        r = self.records[i]
+        start, stop = int(r['start']), int(r['stop'])
+        # the years row and the sample row of the grid file seen as the
+        # two columns of a CalAge
+        itemsize = self._grid.itemsize
+        view = as_strided(self._grid[0, start:],
+                          shape=(stop - start, 2),
+                          strides=(itemsize, (i + 1) * self._grid.shape[1] * itemsize),
+                          writeable=False)
+        cal_age = view.view(core.CalAge)
+        cal_age.radiocarbon_sample = core.R(r['date'], r['sigma'], self.ids[i])
+        cal_age.calibration_curve = self.curve
+        cal_age.discarded_mass = float(r['discarded_mass'])
+        cal_age.intervals68, cal_age.intervals95 = self.intervals(i)
+        return cal_age
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+# filename: backends.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Compute backends for the numeric kernels.
+
+The calibration likelihood, HPD thresholding and cumulative sums are
+delegated to a backend object. ``numpy`` is always available and is the
+default; ``numexpr`` and ``numba`` can be chosen when installed, with
+:func:`set_backend` or the ``IOSACAL_BACKEND`` environment variable.
+Only the chosen backend is imported. ``python -m iosacal.bench`` shows
+whether another backend is faster on a given machine.
+
+'''
+
+import os
+
+import numpy as np
+
+
+def _double(*values):
+    '''True unless some of the values are arrays of another precision.'''
+
+    return all(getattr(v, 'dtype', np.dtype('d')) == np.dtype('d') for v in values)
+
+
+class NumpyBackend(object):
+    '''Pure NumPy kernels, the reference implementation.
+
+    Kernels compute in the precision of their array arguments, so single
+    precision inputs give single precision results.
+
+    '''
+
+    name = 'numpy'
+
+    def calibrate(self, f_m, sigma_m, f_t, sigma_t):
+        '''Calibration likelihood, see :func:`iosacal.core.calibrate`.'''
+
+        sigma_sum = np.square(sigma_m) + np.square(sigma_t)
+        return np.exp(- np.square(f_m - f_t) / (2 * sigma_sum)) / np.sqrt(sigma_sum)
+
+    def log_calibrate(self, f_m, sigma_m, f_t, sigma_t):
+        '''Logarithm of the calibration likelihood.'''
+
+        # in place, so that no more than two arrays of the shape of the
+        # result are alive at the same time
+        sigma_sum = np.asarray(np.square(sigma_m) + np.square(sigma_t))
+        log_p = np.subtract(f_m, f_t)
+        log_p *= log_p
+        log_p /= sigma_sum
+        log_p += np.log(sigma_sum, out=sigma_sum)
+        log_p *= -0.5
+        return log_p
+
+    def cumsum(self, p, axis=-1):
+        '''Cumulative sum along the last axis.'''
+
+        return np.cumsum(p, axis=axis)
+
+    def hpd_threshold(self, p, alpha):
+        '''Probability value above which lies ``1 - alpha`` of the mass.'''
+
+        p_sorted = np.sort(p)[::-1]
+        cumulative = self.cumsum(p_sorted)
+        cumulative /= cumulative[-1]
+        return p_sorted[cumulative.searchsorted(1 - alpha)]
+
+
+class NumexprBackend(NumpyBackend):
+    '''Likelihood evaluated by numexpr, in one multi-threaded pass.
+
+    numexpr turns single precision into double when mixed with the
+    constants of the formula, so single precision is left to NumPy.
+
+    '''
+
+    name = 'numexpr'
+
+    def __init__(self):
+        import numexpr
+        self._evaluate = numexpr.evaluate
+
+    def calibrate(self, f_m, sigma_m, f_t, sigma_t):
+        if not _double(f_m, sigma_m, f_t, sigma_t):
+            return NumpyBackend.calibrate(self, f_m, sigma_m, f_t, sigma_t)
+        return self._evaluate(
+            'exp(- (f_m - f_t) ** 2 / (2 * (sigma_m ** 2 + sigma_t ** 2)))'
+            ' / sqrt(sigma_m ** 2 + sigma_t ** 2)',
+            local_dict={'f_m': f_m, 'sigma_m': sigma_m,
+                        'f_t': f_t, 'sigma_t': sigma_t})
+
+    def log_calibrate(self, f_m, sigma_m, f_t, sigma_t):
+        if not _double(f_m, sigma_m, f_t, sigma_t):
+            return NumpyBackend.log_calibrate(self, f_m, sigma_m, f_t, sigma_t)
+        return self._evaluate(
+            '- (f_m - f_t) ** 2 / (2 * (sigma_m ** 2 + sigma_t ** 2))'
+            ' - 0.5 * log(sigma_m ** 2 + sigma_t ** 2)',
+            local_dict={'f_m': f_m, 'sigma_m': sigma_m,
+                        'f_t': f_t, 'sigma_t': sigma_t})
+
+
+def _numba_kernels():
+    '''Compile the numba kernels, only when the backend is used.'''
+
+    from numba import njit
+
+    @njit(cache=True)
+    def calibrate(f_m, sigma_m, f_t, sigma_t):
+        out = np.empty(f_t.shape[0])
+        for i in range(f_t.shape[0]):
+            sigma_sum = sigma_m * sigma_m + sigma_t[i] * sigma_t[i]
+            d = f_m - f_t[i]
+            out[i] = np.exp(- d * d / (2 * sigma_sum)) / np.sqrt(sigma_sum)
+        return out
+
+    @njit(cache=True)
+    def log_calibrate(f_m, sigma_m, f_t, sigma_t):
+        out = np.empty(f_t.shape[0])
+        for i in range(f_t.shape[0]):
+            sigma_sum = sigma_m * sigma_m + sigma_t[i] * sigma_t[i]
+            d = f_m - f_t[i]
+            out[i] = - d * d / (2 * sigma_sum) - 0.5 * np.log(sigma_sum)
+        return out
+
+    @njit(cache=True)
+    def cumsum(p):
+        out = np.empty(p.shape[0])
+        total = 0.0
+        for i in range(p.shape[0]):
+            total += p[i]
+            out[i] = total
+        return out
+
+    return calibrate, log_calibrate, cumsum
+
+
+class NumbaBackend(NumpyBackend):
+    '''Compiled loops, without the temporary arrays of NumPy expressions.
+
+    The loops handle a scalar radiocarbon determination against 1-d
+    double precision curve arrays, other shapes and precisions fall back
+    to NumPy. Only single calibrations are sped up: the batch paths
+    (``core.BatchCalibration``, ``core._truncate``, :mod:`iosacal.query`
+    and :mod:`iosacal.stats`) work on 2-d and 3-d arrays, and always run
+    the NumPy kernels.
+
+    '''
+
+    name = 'numba'
+
+    def __init__(self):
+        self._calibrate, self._log_calibrate, self._cumsum = _numba_kernels()
+
+    def _loop(self, f_t, sigma_t, *scalars):
+        return (np.ndim(f_t) == 1 and np.ndim(sigma_t) == 1 and
+                all(np.ndim(s) == 0 for s in scalars) and
+                _double(f_t, sigma_t, *scalars))
+
+    def calibrate(self, f_m, sigma_m, f_t, sigma_t):
+        if not self._loop(f_t, sigma_t, f_m, sigma_m):
+            return NumpyBackend.calibrate(self, f_m, sigma_m, f_t, sigma_t)
+        return self._calibrate(float(f_m), float(sigma_m),
+                               np.asarray(f_t, dtype='d'),
+                               np.asarray(sigma_t, dtype='d'))
+
+    def log_calibrate(self, f_m, sigma_m, f_t, sigma_t):
+        if not self._loop(f_t, sigma_t, f_m, sigma_m):
+            return NumpyBackend.log_calibrate(self, f_m, sigma_m, f_t, sigma_t)
+        return self._log_calibrate(float(f_m), float(sigma_m),
+                                   np.asarray(f_t, dtype='d'),
+                                   np.asarray(sigma_t, dtype='d'))
+
+    def cumsum(self, p, axis=-1):
+        if np.ndim(p) != 1 or not _double(p):
+            return NumpyBackend.cumsum(self, p, axis)
+        return self._cumsum(np.ascontiguousarray(p, dtype='d'))
+
+
+BACKENDS = {
+    'numpy': NumpyBackend,
+    'numexpr': NumexprBackend,
+    'numba': NumbaBackend,
+}
+
+DEFAULT = 'numpy'
+
+# order of the names returned by available()
+PREFERENCE = ('numpy', 'numexpr', 'numba')
+
+_instances = {}
+_current = None
+
+
+def load(name):
+    '''Return the backend called ``name``.
+
+    Raise ``ValueError`` for an unknown name and ``ImportError`` when the
+    backend is not installed.
+
+    '''
+
+    try:
+        return _instances[name]
+    except KeyError:
+        pass
+    try:
+        cls = BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown backend %r, choose one of %s' %
+                         (name, ', '.join(sorted(BACKENDS))))
+    _instances[name] = backend = cls()
+    return backend
+
+
+def available():
+    '''Return the names of installed backends, importing all of them.'''
+
+    names = []
+    for name in PREFERENCE:
+        try:
+            load(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def set_backend(name):
+    '''Use the backend called ``name`` from now on, and return it.'''
+
+    global _current
+    _current = load(name)
+    return _current
+
+
+def get_backend():
+    '''Return the backend in use, choosing it on first call.'''
+
+    global _current
+    if _current is None:
+        _current = load(os.environ.get('IOSACAL_BACKEND') or DEFAULT)
+    return _current
+
+
+def check_parity(names=None, rtol=1e-12):
+    '''Compare installed backends against the NumPy reference.
+
+    Return a dictionary mapping each backend name to the largest relative
+    deviation of its kernels on a synthetic curve, and raise
+    ``AssertionError`` if any of them exceeds ``rtol``.
+
+    '''
+
+    reference = load('numpy')
+    rng = np.random.RandomState(0)
+    f_t = np.linspace(50000, 0, 55000) + rng.normal(0, 30, 55000)
+    sigma_t = rng.uniform(10, 1000, 55000)
+    p = reference.calibrate(3000.0, 30.0, f_t, sigma_t)
+    expected = {
+        'calibrate': p,
+        'log_calibrate': reference.log_calibrate(3000.0, 30.0, f_t, sigma_t),
+        'cumsum': reference.cumsum(p),
+        'hpd_threshold': np.array([reference.hpd_threshold(p, a)
+                                   for a in (0.318, 0.046)]),
+        }
+    deviations = {}
+    for name in names or available():
+        backend = load(name)
+        got = {
+            'calibrate': backend.calibrate(3000.0, 30.0, f_t, sigma_t),
+            'log_calibrate': backend.log_calibrate(3000.0, 30.0, f_t, sigma_t),
+            'cumsum': backend.cumsum(p),
+            'hpd_threshold': np.array([backend.hpd_threshold(p, a)
+                                       for a in (0.318, 0.046)]),
+            }
+        worst = 0.0
+        for kernel, value in expected.items():
+            scale = np.maximum(np.abs(value), np.finfo('d').tiny)
+            deviation = (np.abs(got[kernel] - value) / scale).max()
+            if deviation > rtol:
+                raise AssertionError('%s backend: %s deviates by %g' %
+                                     (name, kernel, deviation))
+            worst = max(worst, deviation)
+        deviations[name] = worst
+    return deviations
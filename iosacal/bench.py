@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# filename: bench.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Benchmarks of the numeric kernels.
+
+Run with ``python -m iosacal.bench``.
+
+'''
+
+import sys
+import timeit
+
+import numpy as np
+
+from iosacal import backends, core, curves, span
+from iosacal.store import interval_probabilities
+
+
+def _best(statement, number=5, repeat=3):
+    '''Best time of one call, in milliseconds.'''
+
+    return min(timeit.repeat(statement, number=number, repeat=repeat)) / number * 1000
+
+
+def bench_backends(out=sys.stdout):
+    '''Time each kernel with every installed backend.'''
+
+    curve = curves.get_curve('intcal20')
+    f_t, sigma_t = curve[:,1].copy(), curve[:,2].copy()
+    rs = core.R(3000, 30, 'bench')
+    deviations = backends.check_parity()
+    previous = backends.get_backend()
+    out.write('Backends (%d curve rows, time per call in ms)\n' % len(curve))
+    out.write('%-10s %10s %10s %10s %10s %12s\n' % (
+        'backend', 'calibrate', 'hpd', 'cumsum', 'R.calibrate', 'parity'))
+    try:
+        for name in backends.available():
+            backend = backends.set_backend(name)
+            p = backend.calibrate(3000.0, 30.0, f_t, sigma_t)
+            backend.cumsum(p)       # warm up compiled kernels
+            out.write('%-10s %10.3f %10.3f %10.3f %10.3f %12.2g\n' % (
+                name,
+                _best(lambda: backend.calibrate(3000.0, 30.0, f_t, sigma_t)),
+                _best(lambda: backend.hpd_threshold(p, 0.046)),
+                _best(lambda: backend.cumsum(p)),
+                _best(lambda: rs.calibrate(curve), number=1),
+                deviations[name],
+                ))
+    finally:
+        backends.set_backend(previous.name)
+
+
+def bench_difference(out=sys.stdout):
+    '''Time FFT and direct differences for dates of growing width.'''
+
+    curve = curves.get_curve('intcal20')
+    out.write('\nDifference of two dates (time per call in ms)\n')
+    out.write('%-8s %8s %10s %10s %12s\n' % (
+        'sigma', 'years', 'fft', 'direct', 'deviation'))
+    for sigma in (20, 100, 400, 1000):
+        a = core.R(4500, sigma, 'a').calibrate(curve)
+        b = core.R(3000, sigma, 'b').calibrate(curve)
+        fft = span.difference(a, b)
+        direct = span.difference(a, b, method='direct')
+        out.write('%-8d %8d %10.3f %10.3f %12.2g\n' % (
+            sigma, len(a),
+            _best(lambda: span.difference(a, b)),
+            _best(lambda: span.difference(a, b, method='direct'), number=1),
+            np.abs(np.asarray(fft) - np.asarray(direct)).max(),
+            ))
+
+
+def _precision_deviations(reference, other):
+    '''Largest HPD bound and percentage deviations between two results.
+
+    When the HPD intervals of a sample differ in number, bounds are
+    compared with the nearest bound of the other result and percentages
+    by the total probability of the HPD intervals; such samples are also
+    counted.
+
+    '''
+
+    bounds, percent, mismatched = 0.0, 0.0, 0
+    for a, b in zip(reference, other):
+        mismatch = False
+        for attribute in ('intervals68', 'intervals95'):
+            ia = np.asarray(getattr(a, attribute), dtype='d').reshape(-1, 2)
+            ib = np.asarray(getattr(b, attribute), dtype='d').reshape(-1, 2)
+            pa, pb = interval_probabilities(a, ia), interval_probabilities(b, ib)
+            if ia.shape == ib.shape:
+                if len(ia):
+                    bounds = max(bounds, np.abs(ia - ib).max())
+                    percent = max(percent, np.abs(pa - pb).max())
+                continue
+            mismatch = True
+            ea, eb = ia.ravel(), ib.ravel()
+            if len(ea) and len(eb):
+                nearest = np.abs(ea[:,None] - eb[None,:])
+                bounds = max(bounds, nearest.min(axis=1).max(), nearest.min(axis=0).max())
+            percent = max(percent, abs(pa.sum() - pb.sum()))
+        mismatched += mismatch
+    return bounds, percent * 100, mismatched
+
+
+def validate_precision(out=sys.stdout, dtype='f4', samples=200):
+    '''Compare a calibration precision against double, for each bundled curve.
+
+    Determinations are spread over the whole range of each curve, with
+    errors from 15 to 200 years.
+
+    '''
+
+    registry = curves.CurveRegistry()
+    out.write('\nPrecision %s against float64 (%d samples per curve)\n' % (
+        np.dtype(dtype).name, samples))
+    out.write('%-10s %12s %12s %10s %10s %10s\n' % (
+        'curve', 'bounds (yr)', 'percent (pt)', 'mismatched', 'f8 (ms)', dtype + ' (ms)'))
+    for name in registry.names():
+        curve = registry.load(name)
+        f = np.asarray(curve[:,1])
+        dates = np.linspace(f.min() + 500, f.max() - 500, samples).round()
+        sigmas = np.resize([15, 30, 50, 100, 200], samples)
+        determinations = [core.R(d, s, i)
+                          for i, (d, s) in enumerate(zip(dates, sigmas))]
+        reference = core.calibrate_batch(determinations, curve)
+        other = core.calibrate_batch(determinations, curve, dtype=dtype)
+        bounds, percent, mismatched = _precision_deviations(reference, other)
+        out.write('%-10s %12g %12.4f %10d %10.1f %10.1f\n' % (
+            name, bounds, percent, mismatched,
+            _best(lambda: core.calibrate_batch(determinations, curve), 1, 1),
+            _best(lambda: core.calibrate_batch(determinations, curve, dtype=dtype), 1, 1),
+            ))
+
+
+def main():
+    bench_backends()
+    bench_difference()
+    validate_precision()
+
+
+if __name__ == '__main__':
+    main()
@@ -19,11 +19,11 @@
 # along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-import pkg_resources
 
 from optparse import OptionParser, OptionGroup
 
-from iosacal import core, plot, text
+from iosacal import compare, core, curves, incremental, plot, store, text, worker
+from iosacal.util import parse_size
 
 
 usage = "usage: %prog -d DATE -s SIGMA [other options] ..."
@@ -56,12 +56,75 @@ parser.add_option("-c", "--curve",
                   default="intcal20",
                   type="str",
                   dest="curve",
-                  help="calibration curve to be used [default: %default]")
+                  help="calibration curve to be used, or a comma separated "
+                       "list of curves to compare [default: %default]")
+parser.add_option("--curve-dir",
+                  action="append",
+                  type="str",
+                  dest="curve_dirs",
+                  default=[],
+                  metavar="DIR",
+                  help="additional directory of .14c calibration curves")
+parser.add_option("--list-curves",
+                  action="store_true",
+                  dest="list_curves",
+                  default=False,
+                  help="list available calibration curves and exit")
+parser.add_option("--serve-stdio",
+                  action="store_true",
+                  dest="serve_stdio",
+                  default=False,
+                  help="run as a worker answering JSON requests on stdin, "
+                       "one per line")
+parser.add_option("--update-archive",
+                  type="str",
+                  dest="update_archive",
+                  default=None,
+                  metavar="DIR",
+                  nargs=2,
+                  help="calibrate the new and changed rows of a CSV table "
+                       "(id, date, sigma) into an archive directory: "
+                       "--update-archive TABLE DIR")
+parser.add_option("--precision",
+                  type="choice",
+                  choices=["double", "single"],
+                  dest="precision",
+                  default="double",
+                  help="floating point precision of the calibration, single "
+                       "is faster and uses half the memory [default: %default]")
+parser.add_option("--store",
+                  type="str",
+                  dest="store",
+                  default=None,
+                  metavar="DB",
+                  help="SQLite file where the HPD intervals of calibrated "
+                       "samples are added, and where queries are run")
+parser.add_option("--max-memory",
+                  type="str",
+                  dest="max_memory",
+                  default=None,
+                  metavar="SIZE",
+                  help="memory for the working arrays of batch calibration, "
+                       "like 512M or 2G; results are written as each chunk "
+                       "of samples is done")
 parser.add_option("-o", "--oxcal",
                   action="store_true",
                   dest="oxcal",
                   default=False,
                   help="draw plots more OxCal-like looking [default: %default]")
+parser.add_option("--summary",
+                  action="store_true",
+                  dest="summary",
+                  default=False,
+                  help="output a table of point estimates and quantiles of "
+                       "all samples instead of the full text of each")
+parser.add_option("--pdf",
+                  type="str",
+                  dest="pdf",
+                  default=None,
+                  metavar="FILE",
+                  help="with --plot, write all single plots as pages of one "
+                       "PDF file instead of one file per sample")
 parser.add_option("-n", "--name",
                   default="iosacal",
                   type="str",
@@ -98,36 +161,161 @@ group.add_option("--ad",
                 dest="BP",
                 help="express date in Calibrated BC/AD Calendar Age")
 parser.add_option_group(group)
+group1 = OptionGroup(parser, 'Store queries',
+                     'Find samples in the --store database by the calBP '
+                     'years of their HPD intervals.')
+for flag, help in (('overlapping', 'intervals overlapping the range'),
+                   ('within', 'intervals entirely within the range'),
+                   ('containing', 'intervals containing the whole range')):
+    group1.add_option("--%s" % flag,
+                      type="float",
+                      nargs=2,
+                      dest=flag,
+                      default=None,
+                      metavar="START END",
+                      help=help)
+group1.add_option("--level",
+                  type="int",
+                  dest="level",
+                  default=95,
+                  help="HPD level of the intervals, 68 or 95 [default: %default]")
+group1.add_option("--min-probability",
+                  type="float",
+                  dest="min_probability",
+                  default=0.0,
+                  metavar="P",
+                  help="only intervals holding at least P (0-1) of their "
+                       "sample [default: %default]")
+parser.add_option_group(group1)
+
+QUERIES = ('overlapping', 'within', 'containing')
+
+PRECISIONS = {'double': 'f8', 'single': 'f4'}
 
 (options, args) = parser.parse_args()
-if not (options.date and options.sigma):
+queries = [q for q in QUERIES if getattr(options, q) is not None]
+if queries and not options.store:
+    parser.error('Store queries need --store')
+if not (options.date and options.sigma) and not (options.list_curves or
+                                                 options.serve_stdio or
+                                                 options.update_archive or
+                                                 queries):
     parser.error('Please provide date and standard deviation')
 
+def _plot_name(name, rs, used):
+    '''File name for the single plot of a sample, unique within a run.'''
+
+    stem = '%s_%d±%d' % (name, rs.date, rs.sigma)
+    if rs.id is not None:
+        stem = '%s_%s_%d±%d' % (name, rs.id, rs.date, rs.sigma)
+    outputname, n = '%s.pdf' % stem, 1
+    while outputname in used:
+        n += 1
+        outputname = '%s_%d.pdf' % (stem, n)
+    used.add(outputname)
+    return outputname
+
+def _query_store():
+    '''Run the store queries given on the command line.'''
+
+    if not queries:
+        return
+    with store.ResultStore(options.store) as result_store:
+        for query in QUERIES:
+            years = getattr(options, query)
+            if years is None:
+                continue
+            rows = getattr(result_store, query)(
+                years[0], years[1], level=options.level,
+                min_probability=options.min_probability)
+            title = 'Intervals %s %d-%d calBP (%d found)' % (
+                query, years[0], years[1], len(rows))
+            sys.stdout.write(text.store_text(title, rows))
+
 def main():
     """Main program procedure.
 
     By default produces text output to stdout for each sample."""
 
-    # resource_string actually returns bytes
-    curve_data_bytes = pkg_resources.resource_string("iosacal", "data/%s.14c" % options.curve)
-    curve_data_string = curve_data_bytes.decode('latin1')
-    curve = core.CalibrationCurve(curve_data_string)
-    calibrated_ages = []
-    for d, s, id in zip(options.date, options.sigma, options.id):
-        rs = core.R(d, s, id)
-        ca = rs.calibrate(options.curve)
-        calibrated_ages.append(ca)
-        if options.plot and options.single is True:
-            outputname = '%s_%d±%d.pdf' %(options.name, d, s)
-            plot.single_plot(ca,oxcal=options.oxcal,output=outputname)
-        else:
-            sys.stdout.write(text.single_text(ca))
+    for directory in options.curve_dirs:
+        curves.registry.add_directory(directory)
+    if options.list_curves:
+        for info in curves.registry:
+            sys.stdout.write('%s\n' % info)
+        return
+    if options.serve_stdio:
+        worker.serve(sys.stdin, sys.stdout, default_curve=options.curve)
+        return
+    max_memory = parse_size(options.max_memory) if options.max_memory else None
+    if options.update_archive:
+        table, path = options.update_archive
+        stats = incremental.update(table, path, options.curve,
+                                   max_memory=max_memory)
+        sys.stdout.write('%s: %d new, %d changed, %d unchanged, %d removed '
+                         'rows%s\n' % (path, stats['new'], stats['changed'],
+                                       stats['unchanged'], stats['removed'],
+                                       ' (full recalibration)' if stats['full'] else ''))
+        return
+    if not options.date:
+        _query_store()
+        return
+    curve_names = options.curve.split(',')
+    ids = options.id or [None] * len(options.date)
+    determinations = [core.R(d, s, id)
+                      for d, s, id in zip(options.date, options.sigma, ids)]
+    if len(curve_names) > 1:
+        names = ['%s_%s' % (options.name, c) for c in curve_names]
+    else:
+        names = [options.name]
+    batch = core.BatchCalibration(determinations, curve_names,
+                                  max_memory=max_memory,
+                                  dtype=PRECISIONS[options.precision])
+    # whole results are only kept for compound plots and comparisons
+    keep = (options.plot and options.multi) or len(curve_names) > 1
+    result_store = store.ResultStore(options.store) if options.store else None
+    single_plots = options.plot and options.single is True
+    summary = options.summary and not single_plots
+    pdf = plot.PdfPages(options.pdf) if single_plots and options.pdf else None
+    used = set()
+    results = [[] for c in curve_names]
+    for n, chunk in enumerate(batch):
+        for name, calibrated_ages, result in zip(names, chunk, results):
+            if summary and len(curve_names) == 1:
+                sys.stdout.write(text.summary_text(calibrated_ages, header=n == 0))
+            for ca in calibrated_ages:
+                if single_plots:
+                    output = (pdf if pdf is not None else
+                              _plot_name(name, ca.radiocarbon_sample, used))
+                    plot.single_plot(ca,oxcal=options.oxcal,output=output)
+                elif not options.summary:
+                    sys.stdout.write(text.single_text(ca))
+            if keep:
+                result.extend(calibrated_ages)
+            if result_store is not None:
+                result_store.extend(calibrated_ages)
+        sys.stdout.flush()
+    if summary and len(curve_names) > 1:
+        for name, calibrated_ages in zip(names, results):
+            sys.stdout.write('\n%s\n%s' % (name, text.summary_text(calibrated_ages)))
+    if pdf is not None:
+        pdf.close()
+    if result_store is not None:
+        result_store.close()
+    if options.max_memory:
+        sys.stderr.write('%s\n' % batch)
     if options.plot and options.multi is True:
-        plot.multi_plot(
-                        calibrated_ages,
-                        oxcal=options.oxcal,
-                        name=options.name
-                        )
+        for name, calibrated_ages in zip(names, results):
+            plot.multi_plot(
+                            calibrated_ages,
+                            oxcal=options.oxcal,
+                            name=name,
+                            BP=options.BP
+                            )
+    for curve_name, calibrated_ages in zip(curve_names[1:], results[1:]):
+        sys.stdout.write(text.comparison_text(
+            curve_names[0], curve_name,
+            compare.compare(results[0], calibrated_ages)))
+    _query_store()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# filename: compare.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Compare calibrations of the same determinations against two curves.'''
+
+import numpy as np
+
+from iosacal.core import calendar_grid
+
+
+def hpd_mask(calibrated_ages, years, attribute='intervals95'):
+    '''Boolean matrix of the years inside the HPD intervals of each age.'''
+
+    mask = np.zeros((len(calibrated_ages), len(years)), dtype=bool)
+    for row, calibrated_age in zip(mask, calibrated_ages):
+        for start, end in getattr(calibrated_age, attribute):
+            first = int(round(years[0] - max(start, end)))
+            last = int(round(years[0] - min(start, end)))
+            row[max(first, 0):last + 1] = True
+    return mask
+
+
+def compare(reference, other):
+    '''Compare two lists of calibrated ages of the same determinations.
+
+    Return a list with a dictionary for each determination:
+
+    ``shift_start``, ``shift_end``
+        change of the oldest and of the most recent bound of the 95.4%
+        HPD range, in years; positive values are older in ``other``.
+        NaN when either calibration has no 95.4% HPD interval, as for
+        dates at the edge of a curve;
+    ``overlap``
+        overlapping coefficient of the two distributions, from 0 (no
+        common probability) to 1 (identical);
+    ``hpd_overlap``
+        years in both 95.4% HPD ranges over years in either of them.
+
+    '''
+
+    ages = list(reference) + list(other)
+    top = max(ca[:,0].max() for ca in ages)
+    bottom = min(ca[:,0].min() for ca in ages)
+    years = np.arange(top, bottom - 1, -1, dtype='d')
+    n = len(reference)
+    _, A = calendar_grid(reference, years)
+    _, B = calendar_grid(other, years)
+    overlap = np.minimum(A, B).sum(axis=1)
+    del A, B
+    mask_a = hpd_mask(reference, years)
+    mask_b = hpd_mask(other, years)
+    union = (mask_a | mask_b).sum(axis=1)
+    hpd_overlap = (mask_a & mask_b).sum(axis=1) / np.maximum(union, 1.0)
+
+    results = []
+    for i in range(n):
+        a, b = reference[i].intervals95, other[i].intervals95
+        if len(a) and len(b):
+            shift_start = np.max(b) - np.max(a)
+            shift_end = np.min(b) - np.min(a)
+        else:
+            shift_start = shift_end = np.nan
+        results.append({
+            'id': reference[i].radiocarbon_sample.id,
+            'shift_start': shift_start,
+            'shift_end': shift_end,
+            'overlap': overlap[i],
+            'hpd_overlap': hpd_overlap[i],
+            })
+    return results
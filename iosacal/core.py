@@ -18,29 +18,81 @@
 # You should have received a copy of the GNU General Public License
 # along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
 
-import pkg_resources
+import sys
 
 from csv import reader
-from math import exp, pow, sqrt
+from itertools import islice
+from math import sqrt
 
 import numpy as np
 
+from iosacal import backends, curves
 from iosacal.hpd import alsuren_hpd, confidence_percent
 
 
-def calibrate(f_m, sigma_m, f_t, sigma_t):
+def _as_dtype(dtype, *values):
+    if dtype is None:
+        return values
+    return tuple(np.asarray(v, dtype=dtype) for v in values)
+
+
+def calibrate(f_m, sigma_m, f_t, sigma_t, dtype=None):
     r'''Calibration formula as defined by Bronk Ramsey 2008.
 
     .. math::
 
        P(t) \propto \frac{\exp \left[-\frac{(f_m - f(t))^2}{2 (\sigma^2_{fm} + \sigma^2_{f}(t))}\right]}{\sqrt{\sigma^2_{fm} + \sigma^2_{f}(t)}}
 
-See doi: 10.1111/j.1475-4754.2008.00394.x for a detailed account.'''
+See doi: 10.1111/j.1475-4754.2008.00394.x for a detailed account.
+
+The formula is evaluated by the active compute backend, see
+:mod:`iosacal.backends`, and works on arrays of curve values. With
+``dtype`` all values are converted first, e.g. to ``'f4'`` for the
+faster single precision tier.'''
+
+    f_m, sigma_m, f_t, sigma_t = _as_dtype(dtype, f_m, sigma_m, f_t, sigma_t)
+    return backends.get_backend().calibrate(f_m, sigma_m, f_t, sigma_t)
+
+
+def log_calibrate(f_m, sigma_m, f_t, sigma_t, dtype=None):
+    '''Logarithm of the calibration formula, see :func:`calibrate`.
 
-    sigma_sum = pow(sigma_m, 2) + pow(sigma_t, 2)
-    P_t = ( exp( - pow(f_m - f_t, 2 ) /
-                   ( 2 * ( sigma_sum ) ) ) / sqrt(sigma_sum) )
-    return P_t
+    Works on arrays of curve values, and it does not underflow far from
+    the radiocarbon determination.'''
+
+    f_m, sigma_m, f_t, sigma_t = _as_dtype(dtype, f_m, sigma_m, f_t, sigma_t)
+    return backends.get_backend().log_calibrate(f_m, sigma_m, f_t, sigma_t)
+
+
+def _truncate(log_p, mass):
+    '''Normalise rows of log-likelihoods and find where to truncate them.
+
+    Each row is truncated with equal tails: ``(1 - mass) / 2`` of its
+    probability is cut from each end, leaving a contiguous window with
+    ``mass`` of it. For skewed or multimodal distributions this is not
+    the narrowest window holding ``mass``.
+    Return the normalised probabilities, the first and last index of
+    the window and the probability left out, for each row. ``log_p`` is
+    overwritten with the probabilities.
+
+    '''
+
+    # scale to the peak before leaving log space, so that dates far
+    # from the curve do not underflow to zero
+    p = log_p
+    p -= log_p.max(axis=1)[:,None]
+    np.exp(p, out=p)
+    cumulative = backends.get_backend().cumsum(p, axis=1)
+    total = cumulative[:,-1:].copy()
+    p /= total
+    cumulative /= total
+    tail = (1 - mass) / 2
+    first = (cumulative <= tail).sum(axis=1)
+    last = np.minimum((cumulative < 1 - tail).sum(axis=1), p.shape[1] - 1)
+    rows = np.arange(len(p))
+    discarded = (1 - cumulative[rows,last] +
+                 np.where(first > 0, cumulative[rows,np.maximum(first - 1, 0)], 0))
+    return p, first, last, np.maximum(discarded, 0.0)
 
 
 class CalibrationCurve(np.ndarray):
@@ -71,6 +123,7 @@ class CalibrationCurve(np.ndarray):
         obj = np.asarray(_darray).view(cls)
         # add the new attribute to the created instance
         obj.title = _lines[0].strip('#\n')
+        obj.name = None
         # Finally, we must return the newly created object:
         return obj
 
@@ -78,6 +131,20 @@ class CalibrationCurve(np.ndarray):
         # see InfoArray.__array_finalize__ for comments
         if obj is None: return
         self.title = getattr(obj, 'title', None)
+        self.name = getattr(obj, 'name', None)
+
+    def __reduce__(self):
+        # curves from the registry are pickled by reference, and loaded
+        # again from the registry when unpickled
+        name, checksum = curves.reference(self)
+        if name is not None:
+            return curves.resolve, (name, checksum)
+        reconstruct, args, state = np.ndarray.__reduce__(self)
+        return reconstruct, args, (state, self.title, self.name)
+
+    def __setstate__(self, state):
+        ndstate, self.title, self.name = state
+        np.ndarray.__setstate__(self, ndstate)
 
     def __str__(self):
         return "CalibrationCurve( %s )" % self.title
@@ -91,22 +158,31 @@ class RadiocarbonDetermination(object):
         self.sigma = sigma
         self.id = id
 
-    def calibrate(self, curve):
-        '''Perform calibration, given a calibration curve.'''
+    def calibrate(self, curve, mass=1 - 1e-6, dtype=None):
+        '''Perform calibration, given a calibration curve.
+
+        The calibrated age is truncated with equal tails, cutting
+        ``(1 - mass) / 2`` of the probability from each end of the
+        calendar range, so that ``mass`` of it is left in a contiguous
+        range of years. Its probabilities are normalised
+        to the whole distribution, and the probability left out is stored
+        as ``discarded_mass``.
+
+        ``dtype`` sets the precision of the likelihood and cumulative
+        sums, see :func:`calibrate`; the result is always double.
+
+        '''
 
         if not isinstance(curve, CalibrationCurve):
-            curve_data_bytes = pkg_resources.resource_string("iosacal", "data/%s.14c" % curve)
-            curve_data_string = curve_data_bytes.decode('latin1')
-            curve = CalibrationCurve(curve_data_string)
-
-        _calibrated_list = []
-        for i in curve:
-            f_t, sigma_t = i[1:3]
-            ca = calibrate(self.date, self.sigma, f_t, sigma_t)
-            # FIXME this treshold value is completely arbitrary
-            if ca > 0.000000001:
-                _calibrated_list.append((i[0],ca))
-        cal_age = CalAge(np.array(_calibrated_list), self, curve)
+            curve = curves.get_curve(curve)
+
+        _curve = np.asarray(curve)
+        log_p = log_calibrate(self.date, self.sigma, _curve[:,1], _curve[:,2],
+                              dtype=dtype)
+        p, first, last, discarded = _truncate(log_p[None,:], mass)
+        window = slice(first[0], last[0] + 1)
+        cal_age = CalAge(np.column_stack((_curve[window,0], p[0,window])),
+                         self, curve, discarded_mass=discarded[0])
         return cal_age
 
     def __str__(self):
@@ -131,13 +207,15 @@ class CalAge(np.ndarray):
 
     '''
 
-    def __new__(cls, input_array, radiocarbon_sample, calibration_curve):
+    def __new__(cls, input_array, radiocarbon_sample, calibration_curve,
+                discarded_mass=0.0):
         # Input array is an already formed ndarray instance
         # We first cast to be our class type
         obj = np.asarray(input_array).view(cls)
         # add the new attribute to the created instance
         obj.radiocarbon_sample = radiocarbon_sample
         obj.calibration_curve = calibration_curve
+        obj.discarded_mass = discarded_mass
         obj.intervals68 = alsuren_hpd(obj,0.318)
         obj.intervals95 = alsuren_hpd(obj,0.046)
         # Finally, we must return the newly created object:
@@ -148,6 +226,25 @@ class CalAge(np.ndarray):
         if obj is None: return
         self.radiocarbon_sample = getattr(obj, 'radiocarbon_sample', None)
         self.calibration_curve = getattr(obj, 'calibration_curve', None)
+        self.discarded_mass = getattr(obj, 'discarded_mass', 0.0)
+
+    def __reduce__(self):
+        # pickling an ndarray drops the attributes of subclasses, so they
+        # are added to its state; the curve pickles itself by reference
+        reconstruct, args, state = np.ndarray.__reduce__(self)
+        intervals = [getattr(self, a, None) for a in ('intervals68', 'intervals95')]
+        meta = (self.radiocarbon_sample, self.calibration_curve, self.discarded_mass,
+                [None if i is None else np.asarray(i) for i in intervals])
+        return reconstruct, args, (state, meta)
+
+    def __setstate__(self, state):
+        ndstate, meta = state
+        np.ndarray.__setstate__(self, ndstate)
+        (self.radiocarbon_sample, self.calibration_curve,
+         self.discarded_mass, intervals) = meta
+        for attribute, value in zip(('intervals68', 'intervals95'), intervals):
+            if value is not None:
+                setattr(self, attribute, value)
 
     def calendar(self):
         '''Return the calibrated age on the calAD calendar scale.
@@ -188,3 +285,230 @@ def combine(determinations):
     desc = 'Combined from {} with test statistic {:.3f}'.format(', '.join(ids), test)
 
     return R(pool_m, pool_s, desc)
+
+
+def wiggle_match(determinations, gaps, curve, mass=1 - 1e-6):
+    '''Wiggle-match a sequence of determinations with known gaps.
+
+    ``gaps`` gives, for each determination, the number of years (tree
+    rings) between it and the final ring of the sequence, so that the
+    final ring is 0 and older rings are positive. The likelihoods of all
+    determinations are shifted by their gaps on the curve grid and
+    multiplied, for every candidate date of the final ring at once.
+
+    Return a ``CalAge`` for the final ring, truncated like the result of
+    ``RadiocarbonDetermination.calibrate``. Its radiocarbon sample is the
+    determination closest to the final ring, with an id describing the
+    match.
+
+    '''
+
+    determinations = list(determinations)
+    if not isinstance(curve, CalibrationCurve):
+        curve = curves.get_curve(curve)
+    gaps = np.rint(np.asarray(gaps, dtype='d')).astype(int)
+    if len(gaps) != len(determinations):
+        raise ValueError('One gap is needed for each determination')
+    if (gaps < 0).any():
+        raise ValueError('Gaps are counted back from the final ring and '
+                         'cannot be negative')
+
+    _curve = np.asarray(curve)
+    G = len(_curve)
+    if gaps.max() >= G:
+        raise ValueError('The sequence is longer than the calibration curve')
+    dates = np.array([d.date for d in determinations], dtype='d')
+    sigmas = np.array([d.sigma for d in determinations], dtype='d')
+    log_p = log_calibrate(dates[:,None], sigmas[:,None],
+                          _curve[None,:,1], _curve[None,:,2])
+
+    # the curve grid runs from the oldest year, so a ring ``gap`` years
+    # older than the final ring at index j lies at index j - gap
+    index = np.arange(G)[None,:] - gaps[:,None]
+    shifted = log_p[np.arange(len(gaps))[:,None], np.maximum(index, 0)]
+    shifted[index < 0] = -np.inf
+    log_match = shifted.sum(axis=0)
+
+    p, first, last, discarded = _truncate(log_match[None,:], mass)
+    window = slice(first[0], last[0] + 1)
+    final = determinations[int(gaps.argmin())]
+    desc = 'Wiggle match of {} with gaps {}'.format(
+        ', '.join(str(d.id) for d in determinations),
+        ', '.join(str(g) for g in gaps))
+    return CalAge(np.column_stack((_curve[window,0], p[0,window])),
+                  R(final.date, final.sigma, desc), curve,
+                  discarded_mass=discarded[0])
+
+
+def calendar_grid(calibrated_ages, years=None):
+    '''Align calibrated ages on a shared calendar grid.
+
+    Return a tuple ``(years, matrix)``. ``years`` is a decreasing
+    sequence of calBP years with 1-year spacing, the same orientation of
+    ``CalibrationCurve``, and covers all the calibrated ages unless it is
+    given explicitly. Each row of ``matrix`` is the normalised
+    probability distribution of the corresponding calibrated age.
+
+    '''
+
+    if years is None:
+        top = max(ca[:,0].max() for ca in calibrated_ages)
+        bottom = min(ca[:,0].min() for ca in calibrated_ages)
+        years = np.arange(top, bottom - 1, -1, dtype='d')
+    matrix = np.zeros((len(calibrated_ages), len(years)))
+    for row, ca in zip(matrix, calibrated_ages):
+        index = np.rint(years[0] - ca[:,0]).astype(int)
+        inside = (index >= 0) & (index < len(years))
+        row[index[inside]] = ca[inside,1]
+        total = row.sum()
+        if total > 0:
+            row /= total
+    return years, matrix
+
+
+# (determinations, curves, years) float arrays alive at the same time
+# while a chunk is calibrated: likelihoods, then probabilities and their
+# cumulative sums
+_WORKING_ARRAYS = 2
+
+# bytes per element of the boolean masks made alongside them, which do
+# not shrink with the precision
+_MASK_BYTES = 1
+
+DEFAULT_MAX_MEMORY = 256 * 1024 ** 2
+
+
+class BatchCalibration(object):
+    '''Calibrate many determinations against several curves, by chunks.
+
+    Curves, given as ``CalibrationCurve`` objects or by name, are aligned
+    on a common calendar grid and all of them are evaluated for a chunk
+    of determinations in one vectorized pass. Unless ``chunk_size`` is
+    given, chunks are as large as possible within ``max_memory`` bytes of
+    working arrays. ``dtype`` sets the precision of the working arrays:
+    single precision, ``'f4'``, nearly halves their size at the cost of
+    about seven significant digits in the probabilities.
+
+    Iterating yields, for each chunk, one list of ``CalAge`` per curve,
+    so results can be written out as they are made; ``determinations``
+    can be any iterable. After iterating, ``count``, ``chunks`` and
+    ``peak_rss`` (the maximum resident memory of the process, where
+    available) describe the run.
+
+    '''
+
+    def __init__(self, determinations, calibration_curves, mass=1 - 1e-6,
+                 chunk_size=None, max_memory=None, dtype='d'):
+        self.determinations = determinations
+        self.dtype = np.dtype(dtype)
+        self.curves = [c if isinstance(c, CalibrationCurve) else curves.get_curve(c)
+                       for c in calibration_curves]
+        self.mass = mass
+        top = max(c[0,0] for c in self.curves)
+        bottom = min(c[-1,0] for c in self.curves)
+        self.years = np.arange(top, bottom - 1, -1, dtype='d')
+        self.max_memory = max_memory or DEFAULT_MAX_MEMORY
+        self.bytes_per_determination = (
+            len(self.curves) * len(self.years) *
+            (_WORKING_ARRAYS * self.dtype.itemsize + _MASK_BYTES))
+        self.chunk_size = chunk_size or max(
+            1, int(self.max_memory // self.bytes_per_determination))
+        self.count = 0
+        self.chunks = 0
+        self.peak_rss = None
+
+    @property
+    def working_bytes(self):
+        '''Size of the working arrays of a full chunk.'''
+
+        return self.chunk_size * self.bytes_per_determination
+
+    def _grid_values(self):
+        # curve values on the common grid, NaN where a curve is not defined
+        top = self.years[0]
+        F = np.full((len(self.curves), len(self.years)), np.nan, dtype=self.dtype)
+        S = np.full_like(F, np.nan)
+        for f, s, c in zip(F, S, self.curves):
+            index = np.rint(top - np.asarray(c[:,0])).astype(int)
+            f[index] = c[:,1]
+            s[index] = c[:,2]
+        return F, S
+
+    def __iter__(self):
+        F, S = self._grid_values()
+        G, k = len(self.years), len(self.curves)
+        determinations = iter(self.determinations)
+        while True:
+            chunk = list(islice(determinations, self.chunk_size))
+            if not chunk:
+                break
+            dates = np.array([d.date for d in chunk], dtype=self.dtype)[:,None,None]
+            sigmas = np.array([d.sigma for d in chunk], dtype=self.dtype)[:,None,None]
+            log_p = log_calibrate(dates, sigmas, F[None], S[None])
+            log_p[np.isnan(log_p)] = -np.inf
+            p, first, last, discarded = _truncate(log_p.reshape(-1, G), self.mass)
+            results = [[] for c in self.curves]
+            for row in range(len(p)):
+                d, c = divmod(row, k)
+                window = slice(first[row], last[row] + 1)
+                results[c].append(CalAge(
+                    np.column_stack((self.years[window], p[row,window])),
+                    chunk[d], self.curves[c], discarded_mass=discarded[row]))
+            del log_p, p
+            self.count += len(chunk)
+            self.chunks += 1
+            self.peak_rss = _peak_rss()
+            yield results
+
+    def __str__(self):
+        report = ('Calibrated %d determinations against %d curves in %d '
+                  'chunks of up to %d (%.1f MB of %s working arrays per chunk, '
+                  'budget %.1f MB)' % (
+                      self.count, len(self.curves), self.chunks, self.chunk_size,
+                      self.working_bytes / 1024. ** 2, self.dtype.name,
+                      self.max_memory / 1024. ** 2))
+        if self.peak_rss is not None:
+            report += '; peak resident memory %.1f MB' % (self.peak_rss / 1024. ** 2)
+        return report
+
+
+def _peak_rss():
+    '''Maximum resident memory of the process in bytes, if known.'''
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on Mac OS X
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def calibrate_multi(determinations, calibration_curves, mass=1 - 1e-6,
+                    chunk_size=None, max_memory=None, dtype='d'):
+    '''Calibrate many determinations against several curves at once.
+
+    Return a list with one list of ``CalAge`` per curve, in the same order
+    of ``determinations``. Results are the same as those of
+    ``RadiocarbonDetermination.calibrate``. See ``BatchCalibration`` for
+    how determinations are split in chunks.
+
+    '''
+
+    batch = BatchCalibration(determinations, calibration_curves, mass,
+                             chunk_size, max_memory, dtype)
+    results = [[] for c in batch.curves]
+    for chunk in batch:
+        for result, calibrated_ages in zip(results, chunk):
+            result.extend(calibrated_ages)
+    return results
+
+
+def calibrate_batch(determinations, curve, mass=1 - 1e-6, chunk_size=None,
+                    max_memory=None, dtype='d'):
+    '''Calibrate many determinations against one curve.
+
+    Return a list of ``CalAge``, see :func:`calibrate_multi`.'''
+
+    return calibrate_multi(determinations, [curve], mass, chunk_size,
+                           max_memory, dtype)[0]
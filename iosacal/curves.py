@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# filename: curves.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Registry of calibration curves.
+
+Curves are ``.14c`` files found in the ``data`` directory of the package
+and in any number of user directories, listed in the ``IOSACAL_CURVE_PATH``
+environment variable (separated like ``PATH``) or added at runtime. The
+index only reads the header and the last line of each file; curve data
+are parsed on first use and then kept in memory.
+
+'''
+
+import hashlib
+import os
+import threading
+
+import pkg_resources
+
+from iosacal import core
+
+EXTENSION = '.14c'
+
+
+def _first_field(line):
+    return float(line.split(b',', 1)[0])
+
+
+class CurveInfo(object):
+    '''Index entry of a calibration curve file.
+
+    ``first_year`` and ``last_year`` are the oldest and the most recent
+    calBP years of the curve, ``kind`` is one of ``'northern'``,
+    ``'southern'``, ``'marine'`` or ``'unknown'``. The ``checksum`` of
+    the whole file is computed only when requested.
+
+    '''
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self._checksum = None
+        with open(path, 'rb') as f:
+            self.title = f.readline().decode('latin1').strip('#\r\n').strip()
+            for line in f:
+                if b'#' not in line and line.strip():
+                    self.first_year = _first_field(line)
+                    break
+            else:
+                raise ValueError('No calibration data in %s' % path)
+            f.seek(max(0, os.path.getsize(path) - 4096))
+            tail = [l for l in f.read().splitlines()
+                    if b'#' not in l and l.strip()]
+            self.last_year = _first_field(tail[-1])
+        self.kind = self._kind()
+
+    def _kind(self):
+        text = ('%s %s' % (self.name, self.title)).lower()
+        if 'marine' in text:
+            return 'marine'
+        if 'shcal' in text or 'southern' in text:
+            return 'southern'
+        if 'intcal' in text or 'northern' in text:
+            return 'northern'
+        return 'unknown'
+
+    @property
+    def checksum(self):
+        '''SHA-256 digest of the curve file.'''
+
+        if self._checksum is None:
+            digest = hashlib.sha256()
+            with open(self.path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 16), b''):
+                    digest.update(block)
+            self._checksum = digest.hexdigest()
+        return self._checksum
+
+    def __str__(self):
+        return '%-12s %-9s %6d %6d  %s' % (
+            self.name, self.kind, self.first_year, self.last_year, self.title)
+
+
+class CurveRegistry(object):
+    '''An index of calibration curves with lazy loading.
+
+    Curves in directories added later take precedence over curves with
+    the same name found earlier, so that the bundled curves can be
+    replaced by custom versions.
+
+    '''
+
+    def __init__(self, directories=(), bundled=True):
+        self.directories = []
+        if bundled:
+            self.directories.append(pkg_resources.resource_filename("iosacal", "data"))
+        self.directories.extend(directories)
+        self._index = None
+        self._curves = {}
+        self._lock = threading.Lock()
+
+    def add_directory(self, path):
+        '''Add a directory of ``.14c`` files to the registry.
+
+        Curves already loaded that are shadowed by a file in ``path``
+        are dropped, and read again from the new file when requested.
+
+        '''
+
+        with self._lock:
+            self.directories.append(path)
+            self._index = None
+            for filename in os.listdir(path):
+                name, ext = os.path.splitext(filename)
+                if ext == EXTENSION:
+                    self._curves.pop(name, None)
+
+    @property
+    def index(self):
+        '''Dictionary mapping curve names to their ``CurveInfo``.'''
+
+        if self._index is None:
+            index = {}
+            for directory in self.directories:
+                for filename in sorted(os.listdir(directory)):
+                    name, ext = os.path.splitext(filename)
+                    if ext == EXTENSION:
+                        index[name] = CurveInfo(name, os.path.join(directory, filename))
+            self._index = index
+        return self._index
+
+    def names(self):
+        return sorted(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return (self.index[name] for name in self.names())
+
+    def info(self, name):
+        try:
+            return self.index[name]
+        except KeyError:
+            raise KeyError('Unknown calibration curve %r, available curves '
+                           'are %s' % (name, ', '.join(self.names())))
+
+    def load(self, name):
+        '''Return the ``CalibrationCurve`` called ``name``.
+
+        Curve data are read the first time a curve is requested; threads
+        asking for the same curve at once share a single copy.
+
+        '''
+
+        try:
+            return self._curves[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._curves:
+                info = self.info(name)
+                with open(info.path, 'rb') as f:
+                    curve = core.CalibrationCurve(f.read().decode('latin1'))
+                curve.name = name
+                self._curves[name] = curve
+        return self._curves[name]
+
+
+def _default_directories():
+    path = os.environ.get('IOSACAL_CURVE_PATH', '')
+    return [d for d in path.split(os.pathsep) if d]
+
+
+registry = CurveRegistry(_default_directories())
+
+
+def get_curve(name):
+    '''Return the calibration curve called ``name`` from the default registry.'''
+
+    return registry.load(name)
+
+
+def reference(curve):
+    '''Return a ``(name, checksum)`` reference to a registry curve.
+
+    Curves that do not come from the registry, including slices and
+    copies of registry curves, have no reference, and ``(None, None)`` is
+    returned.
+
+    '''
+
+    name = getattr(curve, 'name', None)
+    # slices and copies keep the name, but they are not the registry curve
+    if name is None or registry._curves.get(name) is not curve:
+        return None, None
+    return name, registry.info(name).checksum
+
+
+def resolve(name, checksum=None):
+    '''Return the registry curve for a reference made by :func:`reference`.
+
+    Raise ``ValueError`` if the curve file has changed since the
+    reference was made.
+
+    '''
+
+    curve = registry.load(name)
+    if checksum is not None and registry.info(name).checksum != checksum:
+        raise ValueError('Calibration curve %r does not match checksum %s' %
+                         (name, checksum))
+    return curve
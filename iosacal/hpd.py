@@ -20,7 +20,9 @@
 # along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
 
 from copy import copy
-from numpy import asarray
+from numpy import asarray, concatenate, empty_like
+
+from iosacal.backends import get_backend
 
 def findsorted(n, array):
     '''Return sorted array and index of n inside array.'''
@@ -52,24 +54,21 @@ def next(n, array):
 def alsuren_hpd(calibrated_curve, alpha):
     '''Return year spans that have the required Highest Probability Density.'''
     hpd_curve = calibrated_curve.copy()
-    # sort rows by second column in inverse order
-    hpd_sorted = hpd_curve[hpd_curve[:,1].argsort(),][::-1]
-    hpd_cumsum = hpd_sorted[:,1].cumsum()
-    # normalised values
-    hpd_cumsum /= hpd_cumsum[-1]
-    
-    threshold_index = hpd_cumsum.searchsorted(1 - alpha)
-    threshold_p = hpd_sorted[threshold_index][1]
-    threshold_index = calibrated_curve[:,1] > threshold_p
-    hpd = list(hpd_curve[threshold_index,0])
-    
-    confidence_intervals = list()
-    
-    for i in hpd:
-        # ^ is the XOR operator
-        if (prev(i,hpd_curve[:,0]) not in hpd) ^ (next(i,hpd_curve[:,0]) not in hpd):
-            confidence_intervals.append(i)
-    return asarray(confidence_intervals).reshape(len(confidence_intervals)/2,2)
+    threshold_p = get_backend().hpd_threshold(asarray(hpd_curve[:,1]), alpha)
+    threshold_index = asarray(calibrated_curve[:,1] > threshold_p)
+    years = asarray(hpd_curve[:,0])
+
+    # a year is the edge of an interval when only one of its neighbours,
+    # in calendar order, is inside the HPD region
+    order = years.argsort()
+    inside = threshold_index[order]
+    prev_inside = concatenate(([False], inside[:-1]))
+    next_inside = concatenate((inside[1:], [False]))
+    edges = empty_like(inside)
+    edges[order] = inside & (prev_inside != next_inside)
+
+    confidence_intervals = years[edges]
+    return confidence_intervals.reshape(len(confidence_intervals)//2,2)
 
 
 def confidence_percent(years, array):
@@ -78,13 +77,14 @@ def confidence_percent(years, array):
     percent_curve[:,1] /= percent_curve[:,1].sum()
     percent_sorted = percent_curve[percent_curve[:,0].argsort(),]
     
-    year1_index = percent_sorted[:,0].searchsorted([years[0]])
-    year2_index = percent_sorted[:,0].searchsorted([years[1]])
-    indices = [ percent_sorted[:,0].searchsorted([year]) for year in years ]
+    indices = [ percent_sorted[:,0].searchsorted(year) for year in years ]
     indices.sort()
     min_year, max_year = indices
     
-    confidence_interval = percent_sorted[min_year:max_year+1,1]
-    percent_result = confidence_interval.sum()
+    cumulative = get_backend().cumsum(asarray(percent_sorted[:,1]))
+    max_year = min(max_year, len(cumulative) - 1)
+    percent_result = cumulative[max_year]
+    if min_year > 0:
+        percent_result -= cumulative[min_year - 1]
     return percent_result
 
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# filename: incremental.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Incremental calibration of a growing table of determinations.
+
+The table is a CSV file with ``id``, ``date`` and ``sigma`` columns, one
+row per determination, identified by its ``id``. Results are kept in an
+archive (see :mod:`iosacal.archive`) together with a checkpoint,
+``checkpoint.json``, that records the curve, its checksum and grid, the
+calibration settings and a hash of each row with the position of its
+result in the archive.
+
+On each update only new and changed rows are calibrated and appended
+to the archive; the result of a changed row replaces the previous one
+in the checkpoint, which the archive keeps as a stale record. Changing
+the curve or the settings starts the archive again from scratch.
+
+'''
+
+import csv
+import hashlib
+import json
+import os
+
+from iosacal import archive, core, curves
+
+CHECKPOINT = 'checkpoint.json'
+
+VERSION = 1
+
+
+def read_table(path):
+    '''Return the determinations of a CSV table, in file order.
+
+    The first line names the ``id``, ``date`` and ``sigma`` columns, in
+    any order; without it, these three columns are expected in this
+    order. Ids must be unique.
+
+    '''
+
+    with open(path) as f:
+        rows = [row for row in csv.reader(f, skipinitialspace=True) if row]
+    columns = ['id', 'date', 'sigma']
+    if rows and set(c.strip().lower() for c in rows[0]) >= set(columns):
+        header = [c.strip().lower() for c in rows.pop(0)]
+        columns = [header.index(c) for c in columns]
+    else:
+        columns = [0, 1, 2]
+    determinations, seen = [], set()
+    for row in rows:
+        id, date, sigma = (row[c].strip() for c in columns)
+        if id in seen:
+            raise ValueError('Duplicate id %r in %s' % (id, path))
+        seen.add(id)
+        determinations.append(core.R(float(date), float(sigma), id))
+    return determinations
+
+
+def row_hash(determination):
+    '''Hash of the values of a determination, to notice changed rows.'''
+
+    values = json.dumps([float(determination.date), float(determination.sigma)])
+    return hashlib.sha1(values.encode('ascii')).hexdigest()
+
+
+def read_checkpoint(path):
+    '''Return the checkpoint of an archive, or ``None`` if it has none.'''
+
+    try:
+        with open(os.path.join(path, CHECKPOINT)) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def _write_checkpoint(path, checkpoint):
+    # written aside and renamed, so that a checkpoint is never half done
+    filename = os.path.join(path, CHECKPOINT)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(filename + '.tmp', filename)
+
+
+def update(table, path, curve='intcal20', mass=1 - 1e-6, max_memory=None):
+    '''Bring the archive at ``path`` up to date with a table.
+
+    ``table`` is the file name of a CSV table or a list of
+    determinations with unique ids. Return a dictionary with the number
+    of ``new``, ``changed``, ``unchanged`` and ``removed`` rows, and
+    whether the archive was rebuilt from scratch (``full``).
+
+    '''
+
+    if not isinstance(curve, core.CalibrationCurve):
+        curve = curves.get_curve(curve)
+    name, checksum = curves.reference(curve)
+    if name is None:
+        raise ValueError('Incremental calibration needs a registry curve')
+    determinations = read_table(table) if isinstance(table, str) else list(table)
+
+    settings = {
+        'version': VERSION,
+        'curve': name,
+        'checksum': checksum,
+        'top': float(curve[0,0]),
+        'length': len(curve),
+        'mass': mass,
+        }
+    checkpoint = read_checkpoint(path)
+    full = checkpoint is None or checkpoint['settings'] != settings
+    if full:
+        if os.path.isdir(path):
+            # the checkpoint goes first, an interrupted rebuild is redone
+            if checkpoint is not None:
+                os.remove(os.path.join(path, CHECKPOINT))
+            archive.remove(path)
+        rows = {}
+    else:
+        rows = checkpoint['rows']
+
+    todo = []
+    stats = {'new': 0, 'changed': 0, 'unchanged': 0, 'full': full}
+    for d in determinations:
+        key = str(d.id)
+        previous = rows.get(key)
+        if previous is not None and previous[0] == row_hash(d):
+            stats['unchanged'] += 1
+        else:
+            stats['changed' if previous is not None else 'new'] += 1
+            todo.append(d)
+    keys = set(str(d.id) for d in determinations)
+    stats['removed'] = len(set(rows) - keys)
+    rows = dict((k, v) for k, v in rows.items() if k in keys)
+
+    with archive.ArchiveWriter(path, curve) as writer:
+        batch = core.BatchCalibration(todo, [curve], mass, max_memory=max_memory)
+        for (calibrated_ages,) in batch:
+            for calibrated_age in calibrated_ages:
+                d = calibrated_age.radiocarbon_sample
+                rows[str(d.id)] = [row_hash(d), writer.rows]
+                writer.append(calibrated_age)
+            writer.flush()
+            # after each chunk, so an interrupted update resumes from here
+            _write_checkpoint(path, {'settings': settings, 'rows': rows})
+    _write_checkpoint(path, {'settings': settings, 'rows': rows})
+    return stats
+
+
+def current(path):
+    '''Return the up to date results of an archive, by id.
+
+    A dictionary maps the id of every row of the last update to its
+    ``CalAge`` in the archive.
+
+    '''
+
+    rows = read_checkpoint(path)['rows']
+    results = archive.Archive(path)
+    return dict((key, results[index]) for key, (_, index) in rows.items())
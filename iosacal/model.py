@@ -0,0 +1,458 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: model.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Bayesian phase and sequence models.
+
+Dates are grouped in phases, and phases are arranged in a sequence
+separated by boundaries, following the uniform phase model described
+by Bronk Ramsey 2009 (doi: 10.1017/S0033822200033865). The posterior
+is explored with a Metropolis-within-Gibbs sampler that advances many
+chains at once as NumPy arrays: all dates are updated in a single
+block, because they are independent once the boundaries are fixed,
+and boundaries are updated in two alternating blocks.
+
+'''
+
+import time
+
+from multiprocessing import Pool
+
+import numpy as np
+
+from iosacal.core import CalAge, log_calibrate
+from iosacal.util import interval_to_string
+
+
+class Phase(object):
+    '''A group of calibrated ages with no internal ordering.
+
+    All dates in a phase are uniformly distributed between the boundary
+    that starts the phase and the one that ends it.
+
+    '''
+
+    def __init__(self, calibrated_ages, name=None):
+        self.calibrated_ages = list(calibrated_ages)
+        if not self.calibrated_ages:
+            raise ValueError('A phase needs at least one calibrated age')
+        self.name = name
+
+
+class Sequence(object):
+    '''Contiguous phases in chronological order, oldest first.
+
+    Consecutive phases share one boundary, so a sequence of ``k`` phases
+    has ``k + 1`` boundaries. A calibrated age found among the phases is
+    treated as a phase of its own, therefore an ordered sequence of
+    dates can be written as ``Sequence([ca1, ca2, ca3])``.
+
+    '''
+
+    def __init__(self, phases, name=None):
+        self.phases = [p if isinstance(p, Phase) else Phase([p])
+                       for p in phases]
+        if not self.phases:
+            raise ValueError('A sequence needs at least one phase')
+        self.name = name or 'Sequence'
+        for n, phase in enumerate(self.phases):
+            if phase.name is None:
+                phase.name = 'Phase %d' % (n + 1)
+
+    def boundary_names(self):
+        '''Return the names of boundaries, oldest first.'''
+
+        names = ['Start %s' % self.phases[0].name]
+        for older, younger in zip(self.phases[:-1], self.phases[1:]):
+            names.append('Transition %s/%s' % (older.name, younger.name))
+        names.append('End %s' % self.phases[-1].name)
+        return names
+
+
+def _log_likelihood(calibrated_age, years):
+    '''Return the log-likelihood of a calibrated age over ``years``.'''
+
+    curve = calibrated_age.calibration_curve
+    rs = calibrated_age.radiocarbon_sample
+    rows = np.rint(curve[0,0] - years).astype(int)
+    rows = np.clip(rows, 0, len(curve) - 1)
+    return log_calibrate(rs.date, rs.sigma, curve[rows,1], curve[rows,2])
+
+
+class _CompiledModel(object):
+    '''Plain arrays describing a model, as needed by the sampler.
+
+    Parameters live in grid index space: index 0 is the oldest year of
+    the grid and larger indices are younger. Dates are stored grouped by
+    phase.
+
+    '''
+
+    def __init__(self, model, margin):
+        ages = [ca for p in model.phases for ca in p.calibrated_ages]
+        top = max(ca[:,0].max() for ca in ages) + margin
+        bottom = min(ca[:,0].min() for ca in ages) - margin
+        # do not extend the grid beyond any of the calibration curves
+        top = min([top] + [ca.calibration_curve[0,0] for ca in ages])
+        bottom = max([bottom] + [ca.calibration_curve[-1,0] for ca in ages])
+        self.years = np.arange(top, bottom - 1, -1, dtype='d')
+        self.loglik = np.vstack([_log_likelihood(ca, self.years) for ca in ages])
+        sizes = np.array([len(p.calibrated_ages) for p in model.phases])
+        self.phase_sizes = sizes
+        self.phase_starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        self.date_phase = np.repeat(np.arange(len(sizes)), sizes)
+
+    def initial_state(self, rng, chains):
+        '''Draw a valid, overdispersed starting point for each chain.'''
+
+        n, G = self.loglik.shape
+        weights = np.exp(self.loglik - self.loglik.max(axis=1)[:,None])
+        cdf = weights.cumsum(axis=1)
+        cdf /= cdf[:,-1:]
+        u = rng.random_sample((chains, n))
+        draws = np.empty((chains, n))
+        for i in range(n):
+            draws[:,i] = cdf[i].searchsorted(u[:,i])
+        draws += rng.random_sample((chains, n)) - 0.5
+        # reorder the draws so that older phases come first, keeping the
+        # relative order of dates inside each phase
+        ordered = np.sort(draws, axis=1)
+        dates = np.empty((chains, n))
+        K = len(self.phase_sizes)
+        bounds = np.empty((chains, K + 1))
+        for k, (start, size) in enumerate(zip(self.phase_starts, self.phase_sizes)):
+            block = slice(start, start + size)
+            ranks = draws[:,block].argsort(axis=1).argsort(axis=1)
+            dates[:,block] = ordered[np.arange(chains)[:,None], start + ranks]
+            if k:
+                bounds[:,k] = (ordered[:,start - 1] + ordered[:,start]) / 2
+        bounds[:,0] = np.maximum(ordered[:,0] - 0.5, 0)
+        bounds[:,K] = np.minimum(ordered[:,-1] + 0.5, G - 1)
+        return dates, bounds
+
+    def initial_steps(self):
+        '''Proposal scale for each date, from the likelihood spread.'''
+
+        weights = np.exp(self.loglik - self.loglik.max(axis=1)[:,None])
+        weights /= weights.sum(axis=1)[:,None]
+        index = np.arange(self.loglik.shape[1])
+        mean = weights.dot(index)
+        var = weights.dot(index ** 2) - mean ** 2
+        return np.sqrt(np.maximum(var, 1.0))
+
+
+def _boundary_logprior(b, prev, nxt, n_prev, n_next):
+    '''Uniform phase prior, as a function of one boundary.'''
+
+    return (- n_prev * np.log(np.maximum(b - prev, 1.0))
+            - n_next * np.log(np.maximum(nxt - b, 1.0)))
+
+
+def _sequence_logprior(bounds, sizes):
+    '''Uniform phase prior of all boundaries, for each chain.'''
+
+    spans = np.maximum(np.diff(bounds, axis=1), 1.0)
+    return - (sizes * np.log(spans)).sum(axis=1)
+
+
+def _run_chains(compiled, chains, iterations, burn, thin, seed):
+    '''Run ``chains`` chains of the sampler at once.
+
+    Return a dictionary of accumulated statistics: the posterior
+    histogram of each parameter on the grid, per-chain sums and sums of
+    squares of the kept samples, and acceptance rates.
+
+    '''
+
+    rng = np.random.RandomState(seed)
+    n, G = compiled.loglik.shape
+    K = len(compiled.phase_sizes)
+    P = n + K + 1
+    flat = compiled.loglik.ravel()
+    offsets = np.arange(n) * G
+    date_phase = compiled.date_phase
+    sizes = compiled.phase_sizes
+
+    dates, bounds = compiled.initial_state(rng, chains)
+    ll = flat[offsets + np.rint(dates).astype(int)]
+    date_step = compiled.initial_steps()
+    bound_step = np.full(K + 1, date_step.mean())
+    # runs of 1, 2-3, 4-7, ... phases have their own shift scale
+    sizes_log2 = int(np.log2(K)) + 1
+    shift_step = np.full(sizes_log2, date_step.mean())
+
+    # boundary blocks: even and odd boundaries are updated in turn
+    blocks = []
+    for parity in (0, 1):
+        ks = np.arange(parity, K + 1, 2)
+        has_prev = ks >= 1
+        has_next = ks < K
+        blocks.append((
+            ks, has_prev, has_next,
+            np.clip(ks - 1, 0, K), np.clip(ks + 1, 0, K),
+            np.where(has_prev, sizes[np.clip(ks - 1, 0, K - 1)], 0),
+            np.where(has_next, sizes[np.clip(ks, 0, K - 1)], 0),
+            ))
+
+    date_accepted = np.zeros(n)
+    bound_accepted = np.zeros(K + 1)
+    shift_accepted = np.zeros(sizes_log2)
+    shift_tried = np.zeros(sizes_log2)
+    window = 50
+    kept = 0
+    sums = np.zeros((chains, P))
+    sumsq = np.zeros((chains, P))
+    histogram = np.zeros(P * G)
+    param_offsets = np.arange(P) * G
+    buffer = []
+
+    for it in range(burn + iterations):
+        # dates, all at once
+        prop = dates + rng.standard_normal((chains, n)) * date_step
+        inside = ((prop > bounds[:,date_phase]) &
+                  (prop < bounds[:,date_phase + 1]))
+        prop_ll = flat[offsets + np.rint(np.clip(prop, 0, G - 1)).astype(int)]
+        accept = inside & (np.log(rng.random_sample((chains, n))) < prop_ll - ll)
+        dates = np.where(accept, prop, dates)
+        ll = np.where(accept, prop_ll, ll)
+        date_accepted += accept.mean(axis=0)
+
+        # boundaries, in two blocks
+        phase_min = np.minimum.reduceat(dates, compiled.phase_starts, axis=1)
+        phase_max = np.maximum.reduceat(dates, compiled.phase_starts, axis=1)
+        for ks, has_prev, has_next, kp, kn, n_prev, n_next in blocks:
+            b = bounds[:,ks]
+            prev = bounds[:,kp]
+            nxt = bounds[:,kn]
+            lo = np.where(has_prev,
+                          np.maximum(prev, phase_max[:,np.clip(ks - 1, 0, K - 1)]),
+                          0.0)
+            hi = np.where(has_next,
+                          np.minimum(nxt, phase_min[:,np.clip(ks, 0, K - 1)]),
+                          G - 1.0)
+            prop = b + rng.standard_normal(b.shape) * bound_step[ks]
+            log_ratio = (_boundary_logprior(prop, prev, nxt, n_prev, n_next) -
+                         _boundary_logprior(b, prev, nxt, n_prev, n_next))
+            accept = ((prop > lo) & (prop < hi) &
+                      (np.log(rng.random_sample(b.shape)) < log_ratio))
+            bounds[:,ks] = np.where(accept, prop, b)
+            bound_accepted[ks] += accept.mean(axis=0)
+
+        # shift a random run of contiguous phases, with the boundaries
+        # inside it, to jump between the wiggles of the curve
+        length_log2 = rng.randint(0, sizes_log2, size=chains)
+        length = (2 ** (length_log2 + rng.random_sample(chains))).astype(int)
+        first = rng.randint(0, K, size=chains)
+        last = np.minimum(first + length, K)
+        phases = np.arange(K)
+        moved = (phases >= first[:,None]) & (phases < last[:,None])
+        edges = np.arange(K + 1)
+        moved_bounds = (((edges > first[:,None]) & (edges < last[:,None])) |
+                        ((edges == 0) & (first[:,None] == 0)) |
+                        ((edges == K) & (last[:,None] == K)))
+        delta = rng.standard_normal((chains, 1)) * shift_step[length_log2,None]
+        new_dates = dates + delta * moved[:,date_phase]
+        new_bounds = bounds + delta * moved_bounds
+        new_ll = flat[offsets + np.rint(np.clip(new_dates, 0, G - 1)).astype(int)]
+        valid = (
+            (new_dates > new_bounds[:,date_phase]).all(axis=1) &
+            (new_dates < new_bounds[:,date_phase + 1]).all(axis=1) &
+            (new_bounds[:,0] > 0) & (new_bounds[:,-1] < G - 1)
+            )
+        log_ratio = ((new_ll - ll).sum(axis=1) +
+                     _sequence_logprior(new_bounds, sizes) -
+                     _sequence_logprior(bounds, sizes))
+        accept = valid & (np.log(rng.random_sample(chains)) < log_ratio)
+        dates = np.where(accept[:,None], new_dates, dates)
+        bounds = np.where(accept[:,None], new_bounds, bounds)
+        ll = np.where(accept[:,None], new_ll, ll)
+        shift_accepted += np.bincount(length_log2, accept, sizes_log2)
+        shift_tried += np.bincount(length_log2, minlength=sizes_log2)
+
+        if it < burn:
+            # adapt proposal scales towards 44% acceptance
+            if (it + 1) % window == 0:
+                date_step *= np.exp(date_accepted / window - 0.44)
+                bound_step *= np.exp(bound_accepted / window - 0.44)
+                shift_step *= np.exp(shift_accepted / np.maximum(shift_tried, 1) - 0.44)
+                np.clip(date_step, 0.1, G, out=date_step)
+                np.clip(bound_step, 0.1, G, out=bound_step)
+                np.clip(shift_step, 0.1, G, out=shift_step)
+                date_accepted[:] = 0
+                bound_accepted[:] = 0
+                shift_accepted[:] = 0
+                shift_tried[:] = 0
+            if it + 1 == burn:
+                # acceptance is reported for the iterations after burn-in
+                date_accepted[:] = 0
+                bound_accepted[:] = 0
+            continue
+        if (it - burn) % thin:
+            continue
+
+        state = np.hstack((dates, bounds))
+        sums += state
+        sumsq += state ** 2
+        kept += 1
+        buffer.append(np.rint(state).astype(int) + param_offsets)
+        if len(buffer) == 200:
+            histogram += np.bincount(np.ravel(buffer), minlength=P * G)
+            buffer = []
+    if buffer:
+        histogram += np.bincount(np.ravel(buffer), minlength=P * G)
+
+    return {
+        'histogram': histogram.reshape(P, G),
+        'sums': sums,
+        'sumsq': sumsq,
+        'kept': kept,
+        'acceptance': np.concatenate((date_accepted, bound_accepted)) / iterations,
+        }
+
+
+def _run_chains_star(args):
+    return _run_chains(*args)
+
+
+def gelman_rubin(sums, sumsq, n):
+    '''Potential scale reduction factor of each parameter.
+
+    ``sums`` and ``sumsq`` are arrays of shape (chains, parameters) with
+    the sums and sums of squares of ``n`` samples for each chain.
+
+    '''
+
+    m = sums.shape[0]
+    if m < 2 or n < 2:
+        return np.full(sums.shape[1], np.nan)
+    chain_mean = sums / n
+    chain_var = (sumsq - n * chain_mean ** 2) / (n - 1)
+    W = chain_var.mean(axis=0)
+    B = n * chain_mean.var(axis=0, ddof=1)
+    var_hat = (n - 1.0) / n * W + B / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(var_hat / W)
+
+
+class ModelResult(object):
+    '''Posterior distributions and diagnostics of a sampled model.
+
+    ``posteriors`` is an ordered list of ``(name, CalAge)`` pairs, dates
+    first and then boundaries. Each posterior carries the usual
+    ``intervals68`` and ``intervals95`` HPD intervals. ``rhat`` and
+    ``acceptance`` map parameter names to the Gelman-Rubin statistic and
+    to the acceptance rate of the sampler. ``samples`` counts the draws
+    kept after burn-in and thinning, over all chains, and
+    ``samples_per_second`` divides them by the whole run time;
+    ``iterations`` counts all the iterations, burn-in included.
+
+    '''
+
+    def __init__(self, posteriors, rhat, acceptance, samples, elapsed,
+                 iterations=None):
+        self.posteriors = posteriors
+        self.rhat = rhat
+        self.acceptance = acceptance
+        self.samples = samples
+        self.iterations = iterations
+        self.elapsed = elapsed
+        self.samples_per_second = samples / elapsed if elapsed else float('inf')
+
+    def __getitem__(self, name):
+        return dict(self.posteriors)[name]
+
+    def converged(self, threshold=1.1):
+        '''True if the Gelman-Rubin statistic is below ``threshold`` everywhere.'''
+
+        return all(r < threshold for r in self.rhat.values())
+
+    def __str__(self):
+        lines = []
+        for name, posterior in self.posteriors:
+            lines.append('%s (R-hat %.3f)\n' % (name, self.rhat[name]))
+            lines.append('95.4% probability\n')
+            lines.extend(interval_to_string(itv, posterior, True)
+                         for itv in posterior.intervals95)
+        lines.append('%d kept samples in %.1f s (%.0f samples/s)\n' %
+                     (self.samples, self.elapsed, self.samples_per_second))
+        return ''.join(lines)
+
+
+def sample(model, iterations=10000, burn=2000, chains=8, thin=1,
+           processes=1, margin=500, seed=None):
+    '''Sample the posterior of a phase or sequence model.
+
+    ``model`` is a ``Sequence``, or a single ``Phase``. ``chains`` chains
+    are advanced together as arrays; with ``processes`` greater than 1
+    they are split among as many worker processes, each running its own
+    independent chains. ``margin`` is the number of years added to each
+    side of the calendar grid, to leave room for the outer boundaries.
+
+    Return a ``ModelResult``.
+
+    '''
+
+    if isinstance(model, Phase):
+        model = Sequence([model])
+    compiled = _CompiledModel(model, margin)
+    rng = np.random.RandomState(seed)
+    processes = max(1, min(processes, chains))
+    split = [len(c) for c in np.array_split(np.arange(chains), processes)]
+    jobs = [(compiled, c, iterations, burn, thin, s)
+            for c, s in zip(split, rng.randint(2 ** 31 - 1, size=processes))]
+
+    start = time.time()
+    if processes == 1:
+        runs = [_run_chains(*jobs[0])]
+    else:
+        pool = Pool(processes)
+        try:
+            runs = pool.map(_run_chains_star, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+
+    histogram = sum(r['histogram'] for r in runs)
+    sums = np.vstack([r['sums'] for r in runs])
+    sumsq = np.vstack([r['sumsq'] for r in runs])
+    kept = runs[0]['kept']
+    acceptance = sum(r['acceptance'] * c for r, c in zip(runs, split)) / chains
+    rhat = gelman_rubin(sums, sumsq, kept)
+
+    ages = [ca for p in model.phases for ca in p.calibrated_ages]
+    names = ([ca.radiocarbon_sample.id for ca in ages] +
+             model.boundary_names())
+    samples = [ca.radiocarbon_sample for ca in ages] + [None] * (len(names) - len(ages))
+    curve = ages[0].calibration_curve
+    posteriors = []
+    for name, rs, counts in zip(names, samples, histogram):
+        support = np.flatnonzero(counts)
+        window = slice(support[0], support[-1] + 1)
+        array = np.column_stack((compiled.years[window],
+                                 counts[window] / counts.sum()))
+        posteriors.append((name, CalAge(array, rs, curve)))
+
+    return ModelResult(
+        posteriors,
+        dict(zip(names, rhat)),
+        dict(zip(names, acceptance)),
+        chains * kept,
+        elapsed,
+        chains * (burn + iterations),
+        )
@@ -22,9 +22,12 @@ import matplotlib
 matplotlib.use('Agg')
 
 import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
+import numpy as np
 
-from pylab import normpdf
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
 
 from iosacal import hpd, util
 
@@ -32,9 +35,101 @@ COLORS = {
     'bgcolor': '#e5e4e5',
 }
 
-def single_plot(calibrated_age, oxcal=False, output=None, BP=True):
+FIGSIZE = (12, 8)
+DPI = 100
+
+def _normpdf(x, mu, sigma):
+    '''Normal probability density, formerly ``pylab.normpdf``.'''
+
+    return np.exp(-0.5 * ((x - mu) / sigma) ** 2) / (np.sqrt(2 * np.pi) * sigma)
+
+
+def _columns(n, pixels):
+    '''Split ``n`` points in at most ``pixels`` columns of equal length.
+
+    Return the number of points per column and the padded length.'''
+
+    per = -(-n // pixels)
+    return per, -(-n // per) * per
+
+
+def _decimate(x, y, pixels):
+    '''Reduce a series to at most two points per pixel column.
+
+    The minimum and the maximum of each column are kept, in their
+    original order, so the plotted line looks the same as the full one.
+
+    '''
+
+    n = len(x)
+    if n <= 2 * pixels:
+        return x, y
+    per, padded = _columns(n, pixels)
+    columns = np.pad(y, (0, padded - n), mode='edge').reshape(-1, per)
+    base = np.arange(len(columns)) * per
+    index = np.concatenate((
+        [0, n - 1],
+        base + columns.argmin(axis=1),
+        base + columns.argmax(axis=1),
+        ))
+    index = np.unique(np.minimum(index, n - 1))
+    return x[index], y[index]
+
+
+def _band(x, low, high, pixels):
+    '''Return the outline of the band between ``low`` and ``high``.
+
+    Each pixel column is reduced to the lowest and highest value, so the
+    filled polygon covers the same area as the full resolution band.
+
+    '''
+
+    n = len(x)
+    if n > 2 * pixels:
+        per, padded = _columns(n, pixels)
+        x = np.pad(x, (0, padded - n), mode='edge').reshape(-1, per)[:,0]
+        low = np.pad(low, (0, padded - n), mode='edge').reshape(-1, per).min(axis=1)
+        high = np.pad(high, (0, padded - n), mode='edge').reshape(-1, per).max(axis=1)
+    return np.column_stack((
+        np.concatenate((x, x[::-1])),
+        np.concatenate((low, high[::-1])),
+        ))
+
+
+def _curve_layer(calibration_curve, minx, maxx, pixels):
+    '''Decimated band and line of the visible part of a calibration curve.'''
+
+    # do not plot the part of calibration curve that is not visible
+    # greatly reduces execution time \o/
+    years = calibration_curve[:,0]
+    visible = np.asarray(calibration_curve[(years > minx) & (years < maxx)])
+    return (
+        _band(visible[:,0], visible[:,1] - visible[:,2],
+              visible[:,1] + visible[:,2], pixels),
+        _decimate(visible[:,0], visible[:,1], pixels),
+        )
+
+
+def _save(fig, output, format=None):
+    '''Save a figure to a file name, a file object or a ``PdfPages``.'''
+
+    if isinstance(output, PdfPages):
+        output.savefig(fig)
+    else:
+        fig.savefig(output, format=format)
+
+
+def single_plot(calibrated_age, oxcal=False, output=None, BP=True,
+                format=None):
+    '''Plot a calibrated age against its calibration curve.
+
+    ``output`` is a file name, a file object such as ``BytesIO`` or an
+    open ``PdfPages``, where the plot is added as a new page. ``format``
+    is needed for file objects other than ``PdfPages``, unless the
+    matplotlib default (PNG) is wanted.
+
+    '''
 
-    calibrated_age = calibrated_age
     f_m = calibrated_age.radiocarbon_sample.date
     sigma_m = calibrated_age.radiocarbon_sample.sigma
     radiocarbon_sample_id = calibrated_age.radiocarbon_sample.id
@@ -42,37 +137,15 @@ def single_plot(calibrated_age, oxcal=False, output=None, BP=True):
     calibration_curve_title = calibrated_age.calibration_curve.title
     intervals68 = calibrated_age.intervals68
     intervals95 = calibrated_age.intervals95
-    sample_interval = 1950 - calibration_curve[:,0].copy() # for determination plot
-
-    min_year, max_year = (50000, -50000)
-
-    minx = min(calibrated_age[:,0])
-    maxx = max(calibrated_age[:,0])
-
-    if min_year < minx:
-        pass
-    else:
-        min_year = minx
-    if max_year > maxx:
-        pass
-    else:
-        max_year = maxx
 
-    # do not plot the part of calibration curve that is not visible
-    # greatly reduces execution time \o/
-    cutmin = calibration_curve[calibration_curve[:,0]>minx]
-    cutmax = cutmin[cutmin[:,0]<maxx]
-    calibration_curve = cutmax
+    # all series are decimated to the output resolution
+    width, height = FIGSIZE[0] * DPI, FIGSIZE[1] * DPI
 
-    if BP is False:
-        if min_year < 0 and max_year > 0:
-            ad_bp_label = "BC/AD"
-        elif min_year < 0 and max_year < 0:
-            ad_bp_label = "BC"
-        elif min_year > 0 and max_year > 0:
-            ad_bp_label = "AD"
-    else:
-        ad_bp_label = "BP"
+    minx = calibrated_age[:,0].min()
+    maxx = calibrated_age[:,0].max()
+    min_year = min(50000, minx)
+    max_year = max(-50000, maxx)
+    ad_bp_label = _ad_bp_label(min_year, max_year, BP)
 
     string68 = "".join(
         util.interval_to_string(
@@ -85,23 +158,25 @@ def single_plot(calibrated_age, oxcal=False, output=None, BP=True):
             ) for itv in intervals95
         )
 
-    fig = plt.figure(figsize=(12,8))
-    ax1 = plt.subplot(111)
-    ax1.set_axis_bgcolor(COLORS['bgcolor'])
-    plt.xlabel("Calibrated age (%s)" % ad_bp_label)
-    plt.ylabel("Radiocarbon determination (BP)")
-    plt.text(0.5, 0.95,r'%s: $%d \pm %d BP$' % (radiocarbon_sample_id, f_m, sigma_m),
+    # no pyplot state, so that plots can be drawn by several threads
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax1 = fig.add_subplot(111)
+    ax1.set_facecolor(COLORS['bgcolor'])
+    ax1.set_xlabel("Calibrated age (%s)" % ad_bp_label)
+    ax1.set_ylabel("Radiocarbon determination (BP)")
+    ax1.text(0.5, 0.95,r'%s: $%d \pm %d BP$' % (radiocarbon_sample_id, f_m, sigma_m),
          horizontalalignment='center',
          verticalalignment='center',
          transform = ax1.transAxes,
          bbox=dict(facecolor='white', alpha=0.9, lw=0))
-    plt.text(0.75, 0.80,'68.2%% probability\n%s\n95.4%% probability\n%s' \
+    ax1.text(0.75, 0.80,'68.2%% probability\n%s\n95.4%% probability\n%s' \
                  % (string68, string95),
          horizontalalignment='left',
          verticalalignment='center',
          transform = ax1.transAxes,
          bbox=dict(facecolor='white', alpha=0.9, lw=0))
-    plt.text(0.0, 1.0,'IOSACal v0.1; %s' % calibration_curve_title,
+    ax1.text(0.0, 1.0,'IOSACal v0.1; %s' % calibration_curve_title,
          horizontalalignment='left',
          verticalalignment='bottom',
          transform = ax1.transAxes,
@@ -110,65 +185,44 @@ def single_plot(calibrated_age, oxcal=False, output=None, BP=True):
 
     # Calendar Age
 
-    ax2 = plt.twinx()
+    ax2 = ax1.twinx()
 
+    cal_x, cal_y = _decimate(calibrated_age[:,0], calibrated_age[:,1], width)
     if oxcal is True:
         # imitate OxCal
-        ax2.fill(
-            calibrated_age[:,0],
-            calibrated_age[:,1] + max(calibrated_age[:,1])*0.3,
-            'k',
-            alpha=0.3,
-            label='Calendar Age'
-            )
-        ax2.plot(
-            calibrated_age[:,0],
-            calibrated_age[:,1],
-            'k',
-            alpha=0
-            )
+        calendar_polygon = np.column_stack((cal_x, cal_y + cal_y.max()*0.3))
     else:
-        ax2.fill(
-            calibrated_age[:,0],
-            calibrated_age[:,1],
-            'k',
-            alpha=0.3,
-            label='Calendar Age'
-            )
-        ax2.plot(
-            calibrated_age[:,0],
-            calibrated_age[:,1],
-            'k',
-            alpha=0
-            )
-
-    ax2.set_ybound(min(calibrated_age[:,1]),max(calibrated_age[:,1])*3)
-    ax2.set_xbound(min(calibrated_age[:,0]),max(calibrated_age[:,0]))
+        calendar_polygon = np.column_stack((cal_x, cal_y))
+    # a collection does not compute the data limits of every vertex, as
+    # fill() does; all bounds are set explicitly below
+    ax2.add_collection(PolyCollection(
+        [calendar_polygon], facecolors='k', edgecolors='none', alpha=0.3,
+        label='Calendar Age'))
+
+    ax2.set_ybound(cal_y.min(), cal_y.max()*3)
+    ax2.set_xbound(minx, maxx)
     ax2.set_axis_off()
 
     # Radiocarbon Age
-    sample_curve = normpdf(sample_interval, f_m, sigma_m)
-
-    ax3 = plt.twiny(ax1)
-    ax3.fill(
-        sample_curve,
-        sample_interval,
-        'r',
-        alpha=0.3
-        )
+    # FIXME the following values 15 and 5 are arbitrary and could be probably
+    # drawn from the f_m value itself, while preserving their ratio
+    ylow, yhigh = f_m - sigma_m * 15, f_m + sigma_m * 5
+    sample_interval = np.linspace(ylow, yhigh, height)
+    sample_curve = _normpdf(sample_interval, f_m, sigma_m)
+
+    ax3 = ax1.twiny()
+    ax3.add_collection(PolyCollection(
+        [np.column_stack((sample_curve, sample_interval))],
+        facecolors='r', edgecolors='none', alpha=0.3))
     ax3.set_xbound(0,max(sample_curve)*4)
     ax3.set_axis_off()
 
     # Calibration Curve
 
-    mlab_low = calibration_curve[:,1] - calibration_curve[:,2]
-    mlab_high = calibration_curve[:,1] + calibration_curve[:,2]
-
-    xs, ys = mlab.poly_between(calibration_curve[:,0],
-                               mlab_low,
-                               mlab_high)
-    ax1.fill(xs, ys, fc='#000000', ec='none', alpha=0.15)
-    ax1.plot(calibration_curve[:,0], calibration_curve[:,1], '#000000', alpha=0.5)
+    band, (line_x, line_y) = _curve_layer(calibration_curve, minx, maxx, width)
+    ax1.add_collection(PolyCollection(
+        [band], facecolors='#000000', edgecolors='none', alpha=0.15))
+    ax1.plot(line_x, line_y, '#000000', alpha=0.5)
 
     # Confidence intervals
 
@@ -223,95 +277,149 @@ def single_plot(calibrated_age, oxcal=False, output=None, BP=True):
                 facecolor='k',
                 alpha=0.5)
 
-    # FIXME the following values 10 and 5 are arbitrary and could be probably
-    # drawn from the f_m value itself, while preserving their ratio
-    ax1.set_ybound(f_m - sigma_m * 15, f_m + sigma_m * 5)
-    ax1.set_xbound(min(calibrated_age[:,0]),max(calibrated_age[:,0]))
+    ax1.set_ybound(ylow, yhigh)
+    ax1.set_xbound(minx, maxx)
     ax1.invert_xaxis()          # if BP == True
 
     #plt.savefig('image_%d±%d.pdf' %(f_m, sigma_m))
-    if output:
-        plt.savefig(output)
-    fig = plt.gcf()
-    fig.clear()
+    if output is not None:
+        _save(fig, output, format)
 
 
-def multi_plot(calibrated_ages,name,oxcal=False):
+def batch_plot(calibrated_ages, output, oxcal=False, BP=True):
+    '''Plot each calibrated age on a page of one PDF document.
 
-    # Define the legend and descriptive text
+    ``output`` is a file name or a file object, opened once for all the
+    pages.
 
-    min_year, max_year = (50000, -50000)
+    '''
 
-    for calibrated_curve in calibrated_ages:
-        if min_year < min(calibrated_curve.array[:,0]):
-            pass
-        else:
-            min_year = min(calibrated_curve.array[:,0])
-        if max_year > max(calibrated_curve.array[:,0]):
-            pass
-        else:
-            max_year = max(calibrated_curve.array[:,0])
+    with PdfPages(output) as pdf:
+        for calibrated_age in calibrated_ages:
+            single_plot(calibrated_age, oxcal=oxcal, output=pdf, BP=BP)
 
-    if calibrated_ages[0].BP is False:
+
+def _ad_bp_label(min_year, max_year, BP):
+    if BP is False:
         if min_year < 0 and max_year > 0:
             ad_bp_label = "BC/AD"
         elif min_year < 0 and max_year < 0:
             ad_bp_label = "BC"
-        elif min_year > 0 and max_year > 0:
+        else:
             ad_bp_label = "AD"
     else:
         ad_bp_label = "BP"
-
-    fig = plt.figure(1)
-    plt.suptitle("%s" % name )
-    plt.suptitle("Calibrated date (%s)" % ad_bp_label, y = 0.05)
-
-    for n, calibrated_curve in enumerate(calibrated_ages):
-        fignum = 1 + n
-        numrows = len(calibrated_ages)
-        ax1 = fig.add_subplot(numrows,1,fignum)
-
-        # Calendar Age
-
-        ax1.fill(
-            calibrated_curve.array[:,0],
-            calibrated_curve.array[:,1],
-            'k',
-            alpha=0.3,
-            label='Calendar Age'
-            )
-        ax1.plot(
-            calibrated_curve.array[:,0],
-            calibrated_curve.array[:,1],
-            'k',
-            alpha=0
-            )
-        ax1.set_ybound(
-            min(calibrated_curve.array[:,1]),
-            max(calibrated_curve.array[:,1])*2
-            )
-        ax1.set_xbound(min_year, max_year)
-        #ax1.set_axis_off()
-
-        # Confidence intervals
-
-        for i in calibrated_curve.intervals95:
-            ax1.axvspan(
-                min(i),
-                max(i),
-                ymin=0.6,
-                ymax=0.7,
-                facecolor='k',
-                alpha=0.5)
-        for i in calibrated_curve.intervals68:
-            ax1.axvspan(
-                min(i),
-                max(i),
-                ymin=0.6,
-                ymax=0.7,
-                facecolor='k',
-                alpha=0.8)
-
-    plt.savefig('image_%s.png' % name )
-    fig = plt.gcf()
-    fig.clear()
+    return ad_bp_label
+
+
+def _stacked_page(calibrated_ages, first, total, name, ad_bp_label, xbound, BP, oxcal):
+    '''Draw one page of stacked distributions and return the figure.
+
+    Each distribution is scaled to the height of its row, and all of
+    them are drawn with a single collection, as are HPD bars.
+
+    '''
+
+    rows = len(calibrated_ages)
+    height = 1.5 + 0.22 * rows
+    fig = plt.figure(figsize=(8.27, height))
+    # fixed margins in inches, cheaper than tight_layout
+    fig.subplots_adjust(left=0.2, right=0.97, bottom=0.7 / height, top=1 - 0.6 / height)
+    ax1 = fig.add_subplot(111)
+    ax1.set_facecolor('w' if oxcal else COLORS['bgcolor'])
+
+    polygons, bars95, bars68, labels = [], [], [], []
+    for row, calibrated_age in enumerate(calibrated_ages):
+        y0 = rows - row - 1
+        years = calibrated_age[:,0] if BP else 1950 - calibrated_age[:,0]
+        p = calibrated_age[:,1] / calibrated_age[:,1].max() * 0.8
+        polygons.append(np.column_stack((
+            np.concatenate(([years[0]], years, [years[-1]])),
+            np.concatenate(([y0], y0 + p, [y0])),
+            )))
+        # a thinner 68.2% bar drawn over the 95.4% one, below the baseline
+        for intervals, bars, bottom, top in (
+                (calibrated_age.intervals95, bars95, y0 - 0.1, y0 - 0.02),
+                (calibrated_age.intervals68, bars68, y0 - 0.08, y0 - 0.04)):
+            for i in intervals:
+                x0, x1 = (i if BP else 1950 - np.asarray(i))
+                bars.append(((x0, bottom), (x1, bottom), (x1, top), (x0, top)))
+        rs = calibrated_age.radiocarbon_sample
+        labels.append('%s: %d ± %d' % (rs.id, rs.date, rs.sigma))
+
+    ax1.add_collection(PolyCollection(
+        polygons, facecolors='k', edgecolors='none', alpha=0.3))
+    ax1.add_collection(PolyCollection(
+        bars95, facecolors='k', edgecolors='none', alpha=0.5))
+    ax1.add_collection(PolyCollection(
+        bars68, facecolors='k', edgecolors='none', alpha=0.8))
+
+    ax1.set_yticks(np.arange(rows) + 0.3)
+    ax1.set_yticklabels(labels[::-1], size=7)
+    ax1.set_ylim(-0.5, rows)
+    ax1.set_xlim(*xbound)
+    if BP:
+        ax1.invert_xaxis()
+    ax1.set_xlabel("Calibrated date (%s)" % ad_bp_label)
+    ax1.set_title(name, size=10, loc='right')
+    ax1.text(0.0, 1.0, 'IOSACal v0.1; %s (%d-%d of %d)' % (
+        calibrated_ages[0].calibration_curve.title, first + 1, first + rows, total),
+             horizontalalignment='left',
+             verticalalignment='bottom',
+             transform=ax1.transAxes,
+             size=7)
+    return fig
+
+
+def multi_plot(calibrated_ages, name, oxcal=False, BP=True, per_page=50,
+               format='png', output=None):
+    '''Plot many calibrated ages stacked on a common calendar axis.
+
+    Samples are split in pages of ``per_page`` rows. With ``format``
+    ``'pdf'`` all pages go in a single ``<name>.pdf`` file, otherwise each
+    page is saved as ``image_<name>.png``, numbered when there is more
+    than one page. ``output``, a file name, a file object or an open
+    ``PdfPages``, replaces these default files; only PDF output can
+    hold more than one page. Return the list of outputs written.
+
+    '''
+
+    min_year = min(ca[:,0].min() for ca in calibrated_ages)
+    max_year = max(ca[:,0].max() for ca in calibrated_ages)
+    if not BP:
+        min_year, max_year = 1950 - max_year, 1950 - min_year
+    ad_bp_label = _ad_bp_label(min_year, max_year, BP)
+
+    pages = [calibrated_ages[i:i + per_page]
+             for i in range(0, len(calibrated_ages), per_page)]
+    figures = (_stacked_page(page, n * per_page, len(calibrated_ages),
+                             name, ad_bp_label,
+                             (min_year, max_year), BP, oxcal)
+               for n, page in enumerate(pages))
+
+    if isinstance(output, PdfPages):
+        for fig in figures:
+            output.savefig(fig)
+            plt.close(fig)
+        return [output]
+    if format == 'pdf':
+        outputs = [output if output is not None else '%s.pdf' % name]
+        with PdfPages(outputs[0]) as pdf:
+            for fig in figures:
+                pdf.savefig(fig)
+                plt.close(fig)
+    else:
+        if output is not None:
+            if len(pages) > 1:
+                raise ValueError('%d pages do not fit in one %s output, use '
+                                 'PDF or a larger per_page' % (len(pages), format))
+            outputs = [output]
+        elif len(pages) == 1:
+            outputs = ['image_%s.%s' % (name, format)]
+        else:
+            outputs = ['image_%s_%03d.%s' % (name, n + 1, format)
+                       for n in range(len(pages))]
+        for output, fig in zip(outputs, figures):
+            fig.savefig(output, format=format)
+            plt.close(fig)
+    return outputs
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# filename: query.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Probability queries on groups of calibrated ages.
+
+All queries work on the cumulative distributions of calibrated ages
+aligned on a shared calendar grid (see ``core.calendar_grid``). The grid
+runs from the oldest to the most recent year, so the cumulative sum of a
+row at a given year is the probability that the event happened in that
+year or before.
+
+'''
+
+import numpy as np
+
+from iosacal import backends
+from iosacal.core import calendar_grid
+
+
+def cumulative(calibrated_ages, years=None):
+    '''Return the shared grid years and the cumulative distributions.'''
+
+    years, matrix = calendar_grid(calibrated_ages, years)
+    return years, backends.get_backend().cumsum(matrix, axis=1)
+
+
+def order_matrix(calibrated_ages, years=None):
+    '''Probability that each calibrated age is older than each other.
+
+    Return a square matrix where element ``[i, j]`` is the probability
+    that sample ``i`` is older than sample ``j``. Both samples falling in
+    the same calendar year counts for neither, so ``P[i, j] + P[j, i]``
+    can be slightly less than 1.
+
+    '''
+
+    years, matrix = calendar_grid(calibrated_ages, years)
+    F = backends.get_backend().cumsum(matrix, axis=1)
+    # P(i older than j) = sum over years of P(i in year) P(j after year)
+    return matrix.dot((1 - F).T)
+
+
+def probability_before(calibrated_ages, thresholds, years=None):
+    '''Probability that each calibrated age is older than each threshold.
+
+    ``thresholds`` are years calBP. Return a matrix with a row for each
+    calibrated age and a column for each threshold, holding the
+    probability that the event happened before that year.
+
+    '''
+
+    years, F = cumulative(calibrated_ages, years)
+    thresholds = np.asarray(thresholds, dtype='d')
+    # number of grid years strictly older than each threshold
+    older = np.clip(np.ceil(years[0] - thresholds), 0, len(years)).astype(int)
+    padded = np.hstack((np.zeros((len(F), 1)), F))
+    return padded[:,older]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# filename: span.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Elapsed time between calibrated ages.
+
+The distribution of the difference between two events, A − B, is the
+cross-correlation of their calibrated distributions on a 1-year calendar
+grid. It is computed by FFT convolution, in O(n log n) time for
+distributions n years wide; the direct sum over all pairs of years is
+also available, as a reference.
+
+'''
+
+import numpy as np
+
+from iosacal.core import calendar_grid
+from iosacal.hpd import alsuren_hpd
+
+
+class TimeDifference(np.ndarray):
+
+    '''Probability distribution of the time elapsed between two events.
+
+    The first column is the number of years between the ``first`` and
+    the ``second`` calibrated age, positive when the first is older; the
+    second column is its probability. When ``absolute`` is true only the
+    size of the difference is kept, as for the span of a phase.
+
+    '''
+
+    def __new__(cls, input_array, first, second, absolute=False):
+        obj = np.asarray(input_array).view(cls)
+        obj.first = first
+        obj.second = second
+        obj.absolute = absolute
+        obj.intervals68 = alsuren_hpd(obj,0.318)
+        obj.intervals95 = alsuren_hpd(obj,0.046)
+        return obj
+
+    def __array_finalize__(self, obj):
+        if obj is None: return
+        self.first = getattr(obj, 'first', None)
+        self.second = getattr(obj, 'second', None)
+        self.absolute = getattr(obj, 'absolute', False)
+
+
+def _fft_correlate(a, b):
+    '''Return ``c[m] = sum_i a[i] b[m - len(a) + 1 + i]`` by FFT.'''
+
+    n = len(a) + len(b) - 1
+    size = 1 << (n - 1).bit_length()
+    c = np.fft.irfft(np.fft.rfft(a[::-1], size) * np.fft.rfft(b, size), size)[:n]
+    # rounding leaves tiny negative values where there is no probability
+    return np.maximum(c, 0)
+
+
+def _direct_correlate(a, b):
+    '''Same as ``_fft_correlate``, summing over every pair of years.'''
+
+    n = len(a) + len(b) - 1
+    i = np.arange(len(a))[:,None]
+    j = np.arange(len(b))[None,:]
+    return np.bincount((j - i + len(a) - 1).ravel(),
+                       weights=np.outer(a, b).ravel(), minlength=n)
+
+
+METHODS = {
+    'fft': _fft_correlate,
+    'direct': _direct_correlate,
+    }
+
+
+def difference(first, second, absolute=False, method='fft'):
+    '''Distribution of the years elapsed from ``second`` to ``first``.
+
+    Both arguments are calibrated ages; the result is a
+    ``TimeDifference`` with HPD intervals. ``method`` is ``'fft'`` or
+    ``'direct'``, which is much slower for wide distributions.
+
+    '''
+
+    try:
+        correlate = METHODS[method]
+    except KeyError:
+        raise ValueError('Unknown method %r, choose one of %s' %
+                         (method, ', '.join(sorted(METHODS))))
+    # each distribution on its own grid, so that the cost does not
+    # depend on how far apart the two events are
+    (years_a, (a,)), (years_b, (b,)) = calendar_grid([first]), calendar_grid([second])
+    p = correlate(a, b)
+    # year of a[i] minus year of b[j] is (top_a - top_b) + j - i
+    elapsed = years_a[0] - years_b[0] + np.arange(len(p)) - (len(a) - 1)
+    if absolute:
+        folded = np.zeros(int(np.abs(elapsed).max()) + 1)
+        np.add.at(folded, np.abs(elapsed).astype(int), p)
+        elapsed, p = np.arange(len(folded), dtype='d'), folded
+    keep = np.flatnonzero(p)
+    window = slice(keep[0], keep[-1] + 1)
+    return TimeDifference(np.column_stack((elapsed[window], p[window] / p.sum())),
+                          first, second, absolute)
+
+
+def span(first, second, method='fft'):
+    '''Distribution of the years between two events, in either order.'''
+
+    return difference(first, second, absolute=True, method=method)
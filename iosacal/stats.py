@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# filename: stats.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Point estimates and quantiles of calibrated ages.
+
+Statistics are computed for many calibrated ages at once, on their
+probability matrix aligned on a shared calendar grid (see
+``core.calendar_grid``). All values are calBP years.
+
+'''
+
+import numpy as np
+
+from iosacal import backends
+from iosacal.core import CalAge, calendar_grid
+
+QUANTILES = (0.025, 0.16, 0.5, 0.84, 0.975)
+
+
+def summarize(calibrated_ages, years=None, quantiles=QUANTILES):
+    '''Return the mean, standard deviation, mode, median and quantiles.
+
+    ``calibrated_ages`` is a ``CalAge``, a list of them, or a matrix of
+    probabilities with one row per sample on the grid ``years``. The
+    result is a dictionary of arrays with one value per sample, or of
+    numbers for a single ``CalAge``; ``quantiles`` holds one column per
+    requested probability, ``quantile`` of calBP years being the year
+    with that probability of the event being more recent.
+
+    '''
+
+    single = isinstance(calibrated_ages, CalAge)
+    if single:
+        calibrated_ages = [calibrated_ages]
+    if isinstance(calibrated_ages, np.ndarray) and not single:
+        if years is None:
+            raise ValueError('A probability matrix needs its years')
+        years = np.asarray(years, dtype='d')
+        matrix = np.atleast_2d(np.asarray(calibrated_ages, dtype='d'))
+        matrix = matrix / matrix.sum(axis=1)[:,None]
+    else:
+        years, matrix = calendar_grid(calibrated_ages, years)
+
+    mean = matrix.dot(years)
+    variance = matrix.dot(np.square(years)) - np.square(mean)
+    order = np.argsort(years)
+    cumulative = backends.get_backend().cumsum(matrix[:,order], axis=1)
+    sorted_years = years[order]
+    probabilities = np.asarray(quantiles, dtype='d')
+    # index of the first year where the cumulative probability reaches q,
+    # one quantile at a time to keep a single boolean matrix in memory
+    first = lambda q: np.minimum((cumulative < q - 1e-12).sum(axis=1), len(years) - 1)
+    index = np.array([first(q) for q in probabilities], dtype=int).reshape(
+        len(probabilities), len(matrix)).T
+
+    summary = {
+        'mean': mean,
+        'std': np.sqrt(np.maximum(variance, 0)),
+        'mode': years[matrix.argmax(axis=1)],
+        'median': sorted_years[first(0.5)],
+        'quantiles': sorted_years[index],
+        'probabilities': probabilities,
+        }
+    if single:
+        for key in ('mean', 'std', 'mode', 'median', 'quantiles'):
+            summary[key] = summary[key][0]
+    return summary
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# filename: store.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''SQLite store of HPD intervals for calendar range queries.
+
+Calibrated ages are stored as their 68.2% and 95.4% HPD intervals, each
+with the probability it holds. The intervals are indexed by an R*Tree
+(or by B-tree indexes, if SQLite was built without it), so finding the
+samples that overlap or fall within a calendar range does not scan the
+whole store.
+
+'''
+
+import sqlite3
+
+import numpy as np
+
+from iosacal import backends, curves
+
+LEVELS = {68: 'intervals68', 95: 'intervals95'}
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS samples (
+    sample INTEGER PRIMARY KEY,
+    id TEXT,
+    date REAL,
+    sigma REAL,
+    curve TEXT
+);
+CREATE TABLE IF NOT EXISTS intervals (
+    interval INTEGER PRIMARY KEY,
+    sample INTEGER REFERENCES samples,
+    level INTEGER,
+    younger REAL,
+    older REAL,
+    probability REAL
+);
+CREATE INDEX IF NOT EXISTS intervals_sample ON intervals (sample);
+'''
+
+_RTREE = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS interval_index
+USING rtree (interval, younger, older)
+'''
+
+# without R*Tree, a plain table with the same columns and B-tree indexes
+_BTREE = '''
+CREATE TABLE IF NOT EXISTS interval_index (
+    interval INTEGER PRIMARY KEY,
+    younger REAL,
+    older REAL
+);
+CREATE INDEX IF NOT EXISTS interval_younger ON interval_index (younger);
+CREATE INDEX IF NOT EXISTS interval_older ON interval_index (older);
+'''
+
+
+def interval_probabilities(calibrated_age, intervals):
+    '''Probability held by each of the ``intervals`` of a calibrated age.'''
+
+    intervals = np.asarray(intervals, dtype='d').reshape(-1, 2)
+    order = np.argsort(calibrated_age[:,0])
+    years = np.asarray(calibrated_age[:,0])[order]
+    cumulative = backends.get_backend().cumsum(np.asarray(calibrated_age[:,1])[order])
+    cumulative = np.concatenate(([0], cumulative / cumulative[-1]))
+    first = years.searchsorted(intervals.min(axis=1), 'left')
+    last = years.searchsorted(intervals.max(axis=1), 'right')
+    return cumulative[last] - cumulative[first]
+
+
+class ResultStore(object):
+    '''HPD intervals of calibrated ages in a SQLite database.
+
+    ``path`` is a database file, created if needed, or ``':memory:'``.
+    Query methods return lists of ``(id, level, older, younger,
+    probability)`` tuples, one for each matching interval, with years
+    in calBP.
+
+    '''
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_SCHEMA)
+        try:
+            self.connection.execute(_RTREE)
+        except sqlite3.OperationalError:
+            self.connection.executescript(_BTREE)
+        self.connection.commit()
+
+    def extend(self, calibrated_ages):
+        '''Add calibrated ages to the store, in one transaction.'''
+
+        cursor = self.connection.cursor()
+        with self.connection:
+            for calibrated_age in calibrated_ages:
+                rs = calibrated_age.radiocarbon_sample
+                name, _ = curves.reference(calibrated_age.calibration_curve)
+                if name is None:
+                    name = getattr(calibrated_age.calibration_curve, 'title', None)
+                cursor.execute(
+                    'INSERT INTO samples (id, date, sigma, curve) VALUES (?, ?, ?, ?)',
+                    (None if rs.id is None else str(rs.id),
+                     float(rs.date), float(rs.sigma), name))
+                sample = cursor.lastrowid
+                for level, attribute in sorted(LEVELS.items()):
+                    intervals = np.asarray(getattr(calibrated_age, attribute),
+                                           dtype='d').reshape(-1, 2)
+                    probabilities = interval_probabilities(calibrated_age, intervals)
+                    for (a, b), probability in zip(intervals, probabilities):
+                        younger, older = float(min(a, b)), float(max(a, b))
+                        cursor.execute(
+                            'INSERT INTO intervals (sample, level, younger, older, '
+                            'probability) VALUES (?, ?, ?, ?, ?)',
+                            (sample, level, younger, older, float(probability)))
+                        cursor.execute(
+                            'INSERT INTO interval_index VALUES (?, ?, ?)',
+                            (cursor.lastrowid, younger, older))
+
+    def add(self, calibrated_age):
+        self.extend([calibrated_age])
+
+    def __len__(self):
+        return self.connection.execute('SELECT count(*) FROM samples').fetchone()[0]
+
+    def _query(self, condition, args, level, min_probability):
+        # R*Tree bounds are rounded outwards to 32-bit floats, so the
+        # exact values in intervals are checked again
+        sql = ('SELECT s.id, i.level, i.older, i.younger, i.probability '
+               'FROM interval_index x '
+               'JOIN intervals i ON i.interval = x.interval '
+               'JOIN samples s ON s.sample = i.sample '
+               'WHERE %s AND i.level = ? AND i.probability >= ? '
+               'ORDER BY i.older DESC' % condition)
+        if level not in LEVELS:
+            raise ValueError('level must be one of %s' %
+                             ', '.join(str(l) for l in sorted(LEVELS)))
+        return self.connection.execute(
+            sql, tuple(args) + (level, min_probability)).fetchall()
+
+    def overlapping(self, start, end, level=95, min_probability=0.0):
+        '''Intervals that overlap the years from ``start`` to ``end``.
+
+        Only intervals holding at least ``min_probability`` (from 0 to
+        1) of their sample are returned.
+
+        '''
+
+        young, old = min(start, end), max(start, end)
+        return self._query(
+            'x.younger <= ? AND x.older >= ? AND i.younger <= ? AND i.older >= ?',
+            (old, young, old, young), level, min_probability)
+
+    def within(self, start, end, level=95, min_probability=0.0):
+        '''Intervals that lie entirely within the years from ``start`` to ``end``.'''
+
+        young, old = min(start, end), max(start, end)
+        return self._query(
+            'x.younger >= ? AND x.older <= ? AND i.younger >= ? AND i.older <= ?',
+            (young - 1, old + 1, young, old), level, min_probability)
+
+    def containing(self, start, end, level=95, min_probability=0.0):
+        '''Intervals that contain all the years from ``start`` to ``end``.'''
+
+        young, old = min(start, end), max(start, end)
+        return self._query(
+            'x.younger <= ? AND x.older >= ? AND i.younger <= ? AND i.older >= ?',
+            (young, old, young, old), level, min_probability)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# filename: test_backends.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''End to end parity of the compute backends against NumPy.'''
+
+import unittest
+
+import numpy as np
+
+from iosacal import backends, core
+from iosacal.hpd import alsuren_hpd, confidence_percent
+
+DETERMINATIONS = [(3000, 30), (12500, 80), (450, 20), (7000, 300), (25000, 150)]
+
+
+def _results(curve):
+    '''Calibrate all determinations with the backend in use.'''
+
+    single = [core.R(d, s, i).calibrate(curve)
+              for i, (d, s) in enumerate(DETERMINATIONS)]
+    batch = core.calibrate_batch(
+        [core.R(d, s, i) for i, (d, s) in enumerate(DETERMINATIONS)], curve)
+    return single, batch
+
+
+class BackendParityTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.previous = backends.get_backend()
+        backends.set_backend('numpy')
+        cls.curve = 'intcal20'
+        cls.reference = _results(cls.curve)
+
+    @classmethod
+    def tearDownClass(cls):
+        backends.set_backend(cls.previous.name)
+
+    def _check(self, name):
+        try:
+            backends.set_backend(name)
+        except ImportError:
+            self.skipTest('%s is not installed' % name)
+        try:
+            results = _results(self.curve)
+        finally:
+            backends.set_backend('numpy')
+        for expected, got in zip(self.reference, results):
+            for a, b in zip(expected, got):
+                np.testing.assert_array_equal(a[:,0], b[:,0])
+                np.testing.assert_allclose(a[:,1], b[:,1], rtol=1e-12, atol=0)
+                for alpha in (0.318, 0.046):
+                    ia, ib = alsuren_hpd(a, alpha), alsuren_hpd(b, alpha)
+                    np.testing.assert_array_equal(ia, ib)
+                    for i, j in zip(ia, ib):
+                        self.assertAlmostEqual(confidence_percent(i, a),
+                                               confidence_percent(j, b), places=12)
+                np.testing.assert_array_equal(a.intervals68, b.intervals68)
+                np.testing.assert_array_equal(a.intervals95, b.intervals95)
+
+    def test_numpy(self):
+        self._check('numpy')
+
+    def test_numexpr(self):
+        self._check('numexpr')
+
+    def test_numba(self):
+        self._check('numba')
+
+    def test_check_parity(self):
+        deviations = backends.check_parity()
+        self.assertIn('numpy', deviations)
+
+
+if __name__ == '__main__':
+    unittest.main()
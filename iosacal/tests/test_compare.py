@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# filename: test_compare.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Comparison of calibrations against two curves.'''
+
+import unittest
+
+import numpy as np
+
+from iosacal import core, compare, text
+
+
+class CompareTest(unittest.TestCase):
+
+    def test_shifts(self):
+        rs = core.R(3000, 30, 'P-1')
+        a, b = rs.calibrate('intcal20'), rs.calibrate('shcal13')
+        c, = compare.compare([a], [b])
+        self.assertEqual(c['shift_start'], np.max(b.intervals95) - np.max(a.intervals95))
+        self.assertEqual(c['shift_end'], np.min(b.intervals95) - np.min(a.intervals95))
+        self.assertTrue(0 < c['overlap'] < 1)
+
+    def test_no_intervals(self):
+        # beyond the end of shcal04 only a few years are left, and no
+        # 95.4% HPD interval
+        rs = core.R(20000, 100, 'P-2')
+        a, b = rs.calibrate('intcal20'), rs.calibrate('shcal04')
+        self.assertEqual(len(b.intervals95), 0)
+        c, = compare.compare([a], [b])
+        self.assertTrue(np.isnan(c['shift_start']))
+        self.assertTrue(np.isnan(c['shift_end']))
+        self.assertIn('nan', text.comparison_text('intcal20', 'shcal04', [c]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# filename: test_query.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Probability queries against direct sums over calendar years.'''
+
+import unittest
+
+import numpy as np
+
+from iosacal import core, query
+
+
+class QueryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.ages = [core.R(d, s, i).calibrate('intcal20')
+                    for i, (d, s) in enumerate([(3000, 30), (2900, 50), (3100, 25)])]
+
+    def test_probability_before(self):
+        thresholds = [3200, 3200.5, 3199.5, 3100.25, 2999.75, 10000, 0]
+        got = query.probability_before(self.ages, thresholds)
+        for row, age in zip(got, self.ages):
+            years = np.asarray(age[:,0])
+            p = np.asarray(age[:,1]) / age[:,1].sum()
+            expected = [p[years > t].sum() for t in thresholds]
+            np.testing.assert_allclose(row, expected, atol=1e-12)
+
+    def test_half_years(self):
+        p = query.probability_before(self.ages[:1], [3200, 3200.5, 3199.5])[0]
+        self.assertAlmostEqual(p[0], p[1], places=12)
+        self.assertGreater(p[2], p[0])
+
+    def test_order_matrix(self):
+        got = query.order_matrix(self.ages)
+        for i, a in enumerate(self.ages):
+            for j, b in enumerate(self.ages):
+                pa = np.asarray(a[:,1]) / a[:,1].sum()
+                pb = np.asarray(b[:,1]) / b[:,1].sum()
+                older = np.greater.outer(np.asarray(a[:,0]), np.asarray(b[:,0]))
+                self.assertAlmostEqual(got[i, j], (np.outer(pa, pb) * older).sum(),
+                                       places=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,7 +18,7 @@
 # along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
 
 from string import Template
-from iosacal import util
+from iosacal import stats, util
 
 
 def text_dict(calibrated_age):
@@ -35,6 +35,7 @@ def text_dict(calibrated_age):
     intervals68 = calibrated_age.intervals68
     intervals95 = calibrated_age.intervals95
     BP = True
+    summary = stats.summarize(calibrated_age)
 
     string68 = "".join(
         util.interval_to_string(
@@ -57,6 +58,12 @@ def text_dict(calibrated_age):
         'intervals68': string68,
         'intervals95': string95,
         'BP': BP,
+        'discarded_mass': calibrated_age.discarded_mass,
+        'mean': summary['mean'],
+        'std': summary['std'],
+        'mode': summary['mode'],
+        'median': summary['median'],
+        'quantiles': dict(zip(summary['probabilities'], summary['quantiles'])),
         }
 
     return calibrated_data
@@ -66,6 +73,8 @@ def single_text(calibrated_age):
     '''Output calibrated age as text to the terminal.'''
 
     d = text_dict(calibrated_age)
+    d['point_estimates'] = 'median %d, mean %.0f ± %.0f, mode %d' % (
+        d['median'], d['mean'], d['std'], d['mode'])
     output = Template('''
 ============
 IOSACal v0.1
@@ -85,6 +94,62 @@ $calibration_curve_title
 $intervals68
 95.4% probability
 $intervals95
+Point estimates (BP)
+$point_estimates
 ''')
 
     return output.substitute(d)
+
+
+def comparison_text(reference_name, other_name, comparison):
+    '''Output a comparison of two curves, as made by ``compare.compare``.'''
+
+    lines = ['',
+             'Comparison of %s against %s' % (other_name, reference_name),
+             '',
+             '%-20s %12s %12s %8s %12s' % (
+                 'Sample', 'Start shift', 'End shift', 'Overlap', 'HPD overlap'),
+             ]
+    for c in comparison:
+        lines.append('%-20s %12.0f %12.0f %7.1f%% %11.1f%%' % (
+            c['id'], c['shift_start'], c['shift_end'],
+            c['overlap'] * 100, c['hpd_overlap'] * 100))
+    return '\n'.join(lines) + '\n'
+
+
+def summary_text(calibrated_ages, header=True, quantiles=stats.QUANTILES):
+    '''Output point estimates and quantiles of many calibrated ages.
+
+    One line per sample, in calBP years. With ``header`` false only the
+    lines of the samples are returned, to write a table by pieces.
+
+    '''
+
+    summary = stats.summarize(calibrated_ages, quantiles=quantiles)
+    lines = []
+    if header:
+        lines.append('%-20s %8s %8s %8s %8s %8s' % (
+            'Sample', 'Median', 'Mean', 'Std', 'Mode', 'Date') +
+            ''.join(' %7.1f%%' % (q * 100) for q in summary['probabilities']))
+    for i, calibrated_age in enumerate(calibrated_ages):
+        rs = calibrated_age.radiocarbon_sample
+        lines.append('%-20s %8d %8.1f %8.1f %8d %8s' % (
+            rs.id, summary['median'][i], summary['mean'][i], summary['std'][i],
+            summary['mode'][i], '%d±%d' % (rs.date, rs.sigma)) +
+            ''.join(' %8d' % y for y in summary['quantiles'][i]))
+    return '\n'.join(lines) + '\n'
+
+
+def store_text(title, rows):
+    '''Output intervals found in a ``store.ResultStore``.'''
+
+    lines = ['',
+             title,
+             '',
+             '%-20s %6s %8s %8s %12s' % (
+                 'Sample', 'Level', 'From', 'To', 'Probability'),
+             ]
+    for id, level, older, younger, probability in rows:
+        lines.append('%-20s %5d%% %8d %8d %11.1f%%' % (
+            id, level, older, younger, probability * 100))
+    return '\n'.join(lines) + '\n'
@@ -40,3 +40,15 @@ def interval_to_string(interval, calibrated_curve, BP):
     percent = hpd.confidence_percent(interval, calibrated_curve) * 100
     #return u' %s ‒ %s (%2.1f %%)\n' % (i[0], i[1], percent)
     return u' %s - %s (%2.1f %%)\n' % (i[0], i[1], percent)
+
+
+def parse_size(size):
+    '''Return the number of bytes of a size like ``512M`` or ``2G``.
+
+    Suffixes K, M, G and T are powers of 1024; a bare number is bytes.'''
+
+    units = {'K': 1, 'M': 2, 'G': 3, 'T': 4}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * 1024 ** units[size[-1]])
+    return int(size)
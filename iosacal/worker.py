@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# filename: worker.py
+#
+# This file is part of IOSACal, the IOSA Radiocarbon Calibration Library.
+
+# IOSACal is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# IOSACal is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with IOSACal.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Long-lived co-process worker speaking newline-delimited JSON.
+
+Started with ``iosacal --serve-stdio``, the worker reads one JSON request
+per line from standard input and writes one JSON response per line to
+standard output, flushing after each one. Requests are answered in the
+order they arrive, so callers can send many of them without waiting for
+replies, and match responses by their ``id``.
+
+A request is an object with an ``id``, a ``method`` and the parameters
+of the method::
+
+    {"id": 1, "method": "calibrate", "date": 3000, "sigma": 30, "sample": "P-1"}
+
+Methods:
+
+``calibrate``
+    ``date``, ``sigma`` and optional ``sample``, ``curve``,
+    ``distribution`` (include the probability distribution);
+``calibrate_batch``
+    ``determinations``, a list of objects with ``date``, ``sigma`` and
+    ``sample``, and optional ``curve`` and ``distribution``;
+``hpd``
+    ``date``, ``sigma``, ``alpha`` and optional ``curve``: HPD intervals
+    holding ``1 - alpha`` of the probability;
+``percent``
+    ``date``, ``sigma``, ``years`` (a pair of years calBP) and optional
+    ``curve``: probability of the calibrated age within those years;
+``curves``
+    the available calibration curves.
+
+Calibrations are returned with their HPD intervals and percentages, the
+median, mean, standard deviation, mode and quantiles (see
+:func:`iosacal.stats.summarize`).
+
+The response holds the same ``id`` and either a ``result`` or an
+``error`` with its ``type`` and ``message``.
+
+'''
+
+import json
+import sys
+
+from collections import OrderedDict
+
+from iosacal import core, curves, hpd, stats
+
+DEFAULT_CURVE = 'intcal20'
+
+
+class Worker(object):
+    '''Answer requests, keeping curves and recent calibrations in memory.'''
+
+    cache_size = 256
+
+    def __init__(self, default_curve=DEFAULT_CURVE):
+        self.default_curve = default_curve
+        self._cache = OrderedDict()
+        curves.get_curve(default_curve)
+
+    def _calibrate(self, date, sigma, curve):
+        key = (float(date), float(sigma), curve)
+        try:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        except KeyError:
+            pass
+        calibrated_age = core.R(date, sigma, None).calibrate(curves.get_curve(curve))
+        self._cache[key] = calibrated_age
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return calibrated_age
+
+    def _result(self, calibrated_age, sample, curve, distribution=False,
+                summary=None):
+        percent = lambda intervals: [hpd.confidence_percent(i, calibrated_age)
+                                     for i in intervals]
+        rs = calibrated_age.radiocarbon_sample
+        result = {
+            'sample': sample,
+            'date': rs.date,
+            'sigma': rs.sigma,
+            'curve': curve,
+            'intervals68': calibrated_age.intervals68.tolist(),
+            'percent68': percent(calibrated_age.intervals68),
+            'intervals95': calibrated_age.intervals95.tolist(),
+            'percent95': percent(calibrated_age.intervals95),
+            'discarded_mass': calibrated_age.discarded_mass,
+            }
+        if summary is None:
+            summary = stats.summarize(calibrated_age)
+        for key in ('median', 'mean', 'std', 'mode'):
+            result[key] = summary[key]
+        result['quantiles'] = dict(('%g' % p, y) for p, y in
+                                   zip(summary['probabilities'], summary['quantiles']))
+        if distribution:
+            result['distribution'] = calibrated_age.tolist()
+        return result
+
+    def calibrate(self, date, sigma, sample=None, curve=None, distribution=False):
+        curve = curve or self.default_curve
+        return self._result(self._calibrate(date, sigma, curve),
+                            sample, curve, distribution)
+
+    def calibrate_batch(self, determinations, curve=None, distribution=False):
+        curve = curve or self.default_curve
+        rs = [core.R(d['date'], d['sigma'], d.get('sample'))
+              for d in determinations]
+        calibrated_ages = core.calibrate_batch(rs, curve)
+        summary = stats.summarize(calibrated_ages)
+        row = lambda i: dict((k, v if k == 'probabilities' else v[i])
+                             for k, v in summary.items())
+        return [self._result(ca, r.id, curve, distribution, row(i))
+                for i, (ca, r) in enumerate(zip(calibrated_ages, rs))]
+
+    def hpd(self, date, sigma, alpha, curve=None):
+        calibrated_age = self._calibrate(date, sigma, curve or self.default_curve)
+        return hpd.alsuren_hpd(calibrated_age, alpha).tolist()
+
+    def percent(self, date, sigma, years, curve=None):
+        calibrated_age = self._calibrate(date, sigma, curve or self.default_curve)
+        return hpd.confidence_percent(years, calibrated_age)
+
+    def curves(self):
+        return [{'name': info.name, 'title': info.title, 'kind': info.kind,
+                 'first_year': info.first_year, 'last_year': info.last_year}
+                for info in curves.registry]
+
+    methods = ('calibrate', 'calibrate_batch', 'hpd', 'percent', 'curves')
+
+    def handle(self, line):
+        '''Answer one request line, and return the response object.'''
+
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.pop('id', None)
+            method = request.pop('method', None)
+            if method not in self.methods:
+                raise ValueError('Unknown method %r' % method)
+            return {'id': request_id, 'result': getattr(self, method)(**request)}
+        except Exception as e:
+            return {'id': request_id,
+                    'error': {'type': type(e).__name__, 'message': str(e)}}
+
+
+def _default(value):
+    # numpy scalars
+    try:
+        return value.item()
+    except AttributeError:
+        raise TypeError('%r is not JSON serializable' % value)
+
+
+def serve(stdin=sys.stdin, stdout=sys.stdout, default_curve=DEFAULT_CURVE):
+    '''Answer requests from ``stdin`` until it is closed.'''
+
+    worker = Worker(default_curve)
+    for line in iter(stdin.readline, ''):
+        if not line.strip():
+            continue
+        stdout.write(json.dumps(worker.handle(line), default=_default) + '\n')
+        stdout.flush()
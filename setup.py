@@ -31,6 +31,10 @@ setup(name='iosacal',
         'numpy >= 1.7.0',
         'matplotlib >= 1.2.0'
       ],
+      extras_require={
+        'numexpr': ['numexpr'],
+        'numba': ['numba'],
+      },
       entry_points= {
         'console_scripts': [
             'iosacal = iosacal.cli:main',